@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+"""Timing comparisons for the parsing and ontology code.
+
+Usage: python benchmarks.py [file.dat ...]
+Without arguments, benchmarks run on a generated corpus."""
+
+import sys,time
+from utilityclasses import *
+
+
+def make_corpus(filename,nseq=50,nframes=20,nactions=5):
+    """Write a synthetic corpus exercising inheritance and all value types."""
+    fout=open(filename,'w')
+    fout.write('<ontology: atom\nstates: color:(exclusive)\n'
+        'relations: (red,color):(is), (blue,color):(is)\n>\n\n')
+    for s in range(nseq):
+        fout.write('<sequence: seq{}\ntext: Sequence {}, with a comment\n'
+            'tags: tag{}, common\n>\n\n'.format(s,s,s))
+        fout.write('<node: Priest{}\ntags: standing>\n\n'.format(s))
+        for f in range(nframes):
+            fout.write('<frame: frame{}\ntags: step{}\n>\n\n'.format(f,f))
+            for a in range(nactions):
+                fout.write('<action: act{}\ntext: Action {} of frame {}\n'
+                    'tags: walk, slow\nroles: Priest{}:(agent), Fire:(object)\n'
+                    'states: Priest{}:(red,standing), Fire:(lit)\n'
+                    'relations: (Priest{},Fire):(near,facing)\n>\n\n'.format(
+                        a,a,f,s,s,s))
+            if f:
+                fout.write('<action: copy @seq{}|frame{}|act0\n+tags: again\n'
+                    '-states: Fire:(lit)\n>\n\n'.format(s,f))
+    fout.close()
+
+
+def make_template_corpus(filename,nblocks=200,nkeys=100):
+    """Write a corpus where many actions inherit from one large template."""
+    fout=open(filename,'w')
+    fout.write('<sequence: seq\n>\n\n<frame: frame\n>\n\n')
+    fout.write('<action: template\ntags: {}\nstates: {}\n>\n\n'.format(
+        ', '.join('tag{}'.format(k) for k in range(nkeys)),
+        ', '.join('Node{}:(state{})'.format(k,k) for k in range(nkeys)) ))
+    for b in range(nblocks):
+        fout.write('<action: act{} @seq|frame|template\n+tags: extra{}\n>\n\n'.format(
+            b,b))
+    fout.close()
+
+def make_hierarchy(depth=3,width=3):
+    """Database of exclusive categories ('color', 'shape'), each with
+    width subcategories per level down to depth levels, linked by 'is'
+    edges from each atom to its parent."""
+    db=Database('atom')
+    level=['color','shape']
+    db.add_nodes_from((cat,['exclusive']) for cat in level)
+    for d in range(depth):
+        children=[]
+        for parent in level:
+            for k in range(width):
+                child='{}{}'.format(parent,k)
+                db.add_edge(child,parent,'is')
+                children.append(child)
+        level=children
+    return db
+
+
+class LegacyIOHandler(IOHandler):
+    """IOHandler using the regex and replace based line parsing that
+    preceded BlockLexer, for comparison."""
+
+    def read_block(self,obj_txt,current,contents):
+        from copy import deepcopy
+        lines=[l for l in obj_txt.split('$') if l]
+        lines = [l if 'text' in l else l.replace(' ','') for l in lines]
+        typ,sep,uids=lines[0].partition(':')
+        uid,sep,inherit=[x.strip() for x in uids.partition('@')]
+        ancestors=[a.strip() for a in inherit.split(',') if a.strip() ]
+
+        idprefix=''
+        if typ=='action':
+            idprefix='{}|'.format(current[1])
+            uid=idprefix+uid
+            current[2:]=[uid]
+        elif typ=='frame':
+            idprefix='{}|'.format(current[0])
+            uid=idprefix+uid
+            current[1:]=[uid]
+        elif typ=='sequence':
+            uid=idprefix+uid
+            current[:]=[uid]
+
+        content={}
+        for ancestor in ancestors:
+            nbpipes=len(ancestor.split('|'))
+            ancid='|'.join(idprefix.split('|')[nbpipes:])+ancestor.strip()
+            content.update(deepcopy(contents[ancid]))
+        if uid in contents:
+            content.update(deepcopy(contents[uid]))
+
+        for l in lines[1:]:
+            key,sep,val=l.partition(':')
+            if val:
+                clean=re.split(',(?![\s\w,-_]*\))',val)
+                if ':' in val:
+                    listmode=False
+                    cleandict=OrderedDict()
+                    for s in clean:
+                        i,j = [x.replace('(','').replace(')','') for x in s.split(':')]
+                        j=j.split(',')
+                        if i in cleandict:
+                            cleandict[i]+=j
+                        else:
+                            cleandict[i]=j
+                    clean=cleandict
+                else:
+                    listmode=True
+                if key[0]=='+':
+                    key=key[1:]
+                    if listmode:
+                        content[key]+=clean
+                    else:
+                        for i in clean:
+                            content[key].setdefault(i,[])
+                            content[key][i]+=clean[i]
+                elif key[0]=='-':
+                    key=key[1:]
+                    for i in clean:
+                        if listmode:
+                            if i in content[key]:
+                                content[key].remove(i)
+                        else:
+                            content[key].setdefault(i,[])
+                            for j in clean[i]:
+                                if j in content[key][i]:
+                                    content[key][i].remove(j)
+                            if not content[key][i]:
+                                del content[key][i]
+                else:
+                    content[key]=clean
+        contents[uid]={}
+        contents[uid].update(content)
+        return typ,uid,content
+
+class LegacyQueryHandler(QueryHandler):
+    """QueryHandler answering get_relations by enumerating the paths
+    between two atoms, as before ReachabilityIndex, for comparison."""
+
+    def get_relations(self,uid1,uid2,strict=False,is_relation=False):
+        if not is_relation:
+            dbs=self.database
+        else:
+            dbs=self.relation_db
+        rule=self.rule
+        inherit=set(rule.get_types('inherit'))
+        paths=dbs.paths(uid1,uid2)
+        relations=list(dbs.get_edges(uid1,uid2))
+        for path in paths:
+            cur=list(path)
+            if len(cur)==2:
+                continue
+            while len(cur)>=2 and inherit.intersection(dbs.get_edges(cur[0],cur[1])):
+                cur=cur[1:]
+            while len(cur)>=2 and inherit.intersection(dbs.get_edges(cur[-1],cur[-2])):
+                cur=cur[:-1]
+            newrel=[]
+            if len(cur)==2:
+                newrel=list(dbs.get_edges(uid1,uid2))
+            elif len(cur)==1:
+                newrel=rule.inner_relation(dbs.node[cur[0]])
+            relations+=newrel
+        return relations
+
+
+def timed(func,*args,**kwargs):
+    """Return best time of five runs of func (with garbage collection
+    disabled, as in timeit)."""
+    import gc
+    best=None
+    for i in range(5):
+        gc.collect()
+        gc.disable()
+        start=time.time()
+        try:
+            func(*args,**kwargs)
+        finally:
+            t=time.time()-start
+            gc.enable()
+        if best is None or t<best:
+            best=t
+    return best
+
+def bench_parser(filename):
+    """Compare BlockLexer against the legacy line parsing on a file: value
+    lines alone, reading blocks with inheritance, and full parse."""
+    lines=[]
+    for obj_txt in IOHandler().iter_blocks(filename):
+        lines+=[l for l in obj_txt.split('$') if l][1:]
+
+    lexer=BlockLexer()
+    def lex():
+        for l in lines:
+            lexer.line(l)
+    def legacy_lex():
+        for l in lines:
+            l=l if 'text' in l else l.replace(' ','')
+            key,sep,val=l.partition(':')
+            if val:
+                clean=re.split(',(?![\s\w,-_]*\))',val)
+                if ':' in val:
+                    cleandict=OrderedDict()
+                    for s in clean:
+                        i,j = [x.replace('(','').replace(')','') for x in s.split(':')]
+                        j=j.split(',')
+                        if i in cleandict:
+                            cleandict[i]+=j
+                        else:
+                            cleandict[i]=j
+
+    def read_blocks(handler):
+        current,contents=[],{}
+        for obj_txt in handler.iter_blocks(filename):
+            handler.read_block(obj_txt,current,contents)
+
+    def tokenize(spans):
+        for span in spans:
+            pass
+
+    print '{} ({} value lines)'.format(filename,len(lines))
+    for name,old,new in (
+            ('tokenize',lambda:tokenize(IOHandler.scan_blocks(open(filename,'rb'))),
+                lambda:tokenize(IOHandler().iter_spans(filename))),
+            ('lines',legacy_lex,lex),
+            ('blocks',lambda:read_blocks(LegacyIOHandler()),
+                lambda:read_blocks(IOHandler())),
+            ('parse',lambda:LegacyIOHandler().parse(filename),
+                lambda:IOHandler().parse(filename)),
+            ):
+        told,tnew=timed(old),timed(new)
+        print '  {:8} legacy {:8.3f}s   new {:8.3f}s   ({:.2f}x)'.format(
+            name,told,tnew,told/max(tnew,1e-9))
+
+def bench_lazy(filename):
+    """Compare a full parse with loading each sequence through a BlockIndex."""
+    import os
+    index=BlockIndex(filename)
+    tbuild=timed(index.build)
+    uids=index.sequences()
+    if not uids:
+        return
+    tfull=timed(lambda:IOHandler().parse(filename))
+    tone=timed(lambda:IOHandler().load_sequence(filename,uids[len(uids)/2],index))
+    print '  {:8} index {:8.3f}s   full {:8.3f}s   one sequence {:8.3f}s'.format(
+        'lazy',tbuild,tfull,tone)
+    os.remove(index.path)
+
+def bench_binary(filename):
+    """Compare parsing a file with reading the same data in binary format."""
+    import os,tempfile
+    fd,path=tempfile.mkstemp(suffix='.rlb')
+    os.close(fd)
+    handler=IOHandler()
+    handler.export_binary(path,handler.parse(filename))
+    ttext=timed(lambda:IOHandler().parse(filename))
+    tbin=timed(lambda:IOHandler().parse_binary(path))
+    print '  {:8} text {:8.3f}s ({} bytes)   binary {:8.3f}s ({} bytes)'.format(
+        'binary',ttext,os.path.getsize(filename),tbin,os.path.getsize(path))
+    os.remove(path)
+
+def bench_bulk(nnodes=20000,nedges=200000):
+    """Compare loading a Database edge by edge with add_edges_from."""
+    import random
+    rnd=random.Random(0)
+    types=['is','part','near','exclude']
+    edges=[('n{}'.format(rnd.randrange(nnodes)),'n{}'.format(rnd.randrange(nnodes)),
+        rnd.choice(types)) for k in range(nedges)]
+    def one_by_one():
+        db=Database('atom')
+        for i,j,e in edges:
+            db.add_edge(i,j,e)
+    def bulk():
+        Database('atom').add_edges_from(edges)
+    told,tnew=timed(one_by_one),timed(bulk)
+    print 'Database ({} edges)'.format(nedges)
+    print '  {:8} add_edge {:8.3f}s   add_edges_from {:8.3f}s   ({:.2f}x)'.format(
+        'bulk',told,tnew,told/max(tnew,1e-9))
+
+def bench_relations(depth=3,width=3):
+    """Check get_relations for every pair of atoms of a multi-level
+    hierarchy against path enumeration, except that an atom and one of its
+    ancestors do not exclude each other (path enumeration only got this
+    right for direct parents). Compare times."""
+    db=make_hierarchy(depth,width)
+    atoms=list(db.nodes)
+    pairs=[(a,b) for a in atoms for b in atoms if a!=b]
+    old,new=LegacyQueryHandler(db),QueryHandler(db)
+    reach=db.reachability(['is'])
+    for a,b in pairs:
+        if b in reach.ancestors(a) or a in reach.ancestors(b):
+            expected=list(db.get_edges(a,b))
+        else:
+            expected=[]
+            for e in old.get_relations(a,b):
+                if not e in expected:
+                    expected.append(e)
+        assert new.get_relations(a,b)==expected,(a,b,new.get_relations(a,b),expected)
+    def query(handler):
+        for a,b in pairs:
+            handler.get_relations(a,b)
+    told=timed(lambda:query(LegacyQueryHandler(db)))
+    tnew=timed(lambda:query(QueryHandler(db)))
+    print 'QueryHandler ({} atoms, {} pairs checked)'.format(len(atoms),len(pairs))
+    print '  {:8} paths {:8.3f}s   reachability {:8.3f}s   ({:.2f}x)'.format(
+        'relations',told,tnew,told/max(tnew,1e-9))
+
+def bench_exclusions(depth=3,width=3):
+    """Check that ExclusionTable agrees with get_relations on every pair of
+    atoms of a multi-level hierarchy with exclude edges between some of
+    its categories, and compare their times."""
+    db=make_hierarchy(depth,width)
+    db.add_edge('color1','shape2','exclude')
+    db.add_edge('shape01','color','exclude')
+    db.add_edge('color20','color21','exclude')
+    atoms=list(db.nodes)
+    pairs=[(a,b) for a in atoms for b in atoms if a!=b]
+    query=QueryHandler(db)
+    table=query.exclusions()
+    for a,b in pairs:
+        assert table.excludes(a,b)==('exclude' in query.get_relations(a,b)),(a,b)
+    def relations():
+        query=QueryHandler(db)
+        for a,b in pairs:
+            'exclude' in query.get_relations(a,b)
+    def compiled():
+        table=QueryHandler(db).exclusions()
+        for a,b in pairs:
+            table.excludes(a,b)
+    told,tnew=timed(relations),timed(compiled)
+    print '  {:8} get_relations {:8.3f}s   table {:8.3f}s   ({:.2f}x)'.format(
+        'exclude',told,tnew,told/max(tnew,1e-9))
+
+
+if __name__=='__main__':
+    files=sys.argv[1:]
+    if not files:
+        import os,tempfile
+        fd,path=tempfile.mkstemp(suffix='.dat')
+        os.close(fd)
+        make_corpus(path)
+        fd,tpath=tempfile.mkstemp(suffix='.dat')
+        os.close(fd)
+        make_template_corpus(tpath)
+        files=[path,tpath]
+    for f in files:
+        bench_parser(f)
+        bench_lazy(f)
+        bench_binary(f)
+    bench_bulk()
+    bench_relations()
+    bench_exclusions()
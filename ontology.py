@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import re
+from collections import OrderedDict
+from copy import copy
+from functools import wraps
 
 
 class OntologyRuleset(object):
@@ -9,6 +13,7 @@ class OntologyRuleset(object):
 
 
     rule_types={}
+    equivalence_types=() #Symmetric edge types making elements equivalent
 
     def __init__(self):
         self.rules=[rule for typ in self.rule_types for rule in self.rule_types[typ] ]
@@ -28,6 +33,7 @@ class DefaultOntologyRuleset(OntologyRuleset):
         'block', #When an element is meant to prevent another from being
         ]
     }
+    equivalence_types=('equal','translation','variant')
 
 
     def get_types(self,rule):
@@ -63,6 +69,91 @@ class DefaultOntologyRuleset(OntologyRuleset):
 
 
 
+class OrderedSet(object):
+    """Set that remembers insertion order, iterating like a list without
+    duplicates. Membership tests, additions and removals take constant time;
+    index and insert (positional) take linear time.
+
+    Items are stored in a list, with a dict giving the position of each.
+    Removed items leave a hole in the list until there are more holes than
+    items, at which point the list is compacted."""
+
+    HOLE=object()
+
+    def __init__(self,items=()):
+        self.items=[]
+        self.pos={}
+        self.holes=0
+        self.update(items)
+
+    def add(self,x):
+        if not x in self.pos:
+            self.pos[x]=len(self.items)
+            self.items.append(x)
+
+    def update(self,items):
+        """Add items in order, and return the list of those that were new."""
+        pos,lst,new=self.pos,self.items,[]
+        for x in items:
+            if not x in pos:
+                pos[x]=len(lst)
+                lst.append(x)
+                new.append(x)
+        return new
+
+    def remove(self,x):
+        self.items[self.pos.pop(x)]=self.HOLE
+        self.holes+=1
+        if self.holes>16 and self.holes>len(self.pos):
+            self.compact()
+
+    def discard(self,x):
+        if x in self.pos:
+            self.remove(x)
+
+    def compact(self):
+        self.items=[x for x in self.items if not x is self.HOLE]
+        self.pos=dict((x,k) for k,x in enumerate(self.items))
+        self.holes=0
+
+    def index(self,x):
+        if not x in self.pos:
+            raise ValueError('{} is not in OrderedSet'.format(x))
+        self.compact()
+        return self.pos[x]
+
+    def insert(self,index,x):
+        """Move or add x to position index."""
+        self.discard(x)
+        self.compact()
+        self.items.insert(index,x)
+        self.pos=dict((y,k) for k,y in enumerate(self.items))
+
+    def __contains__(self,x):
+        return x in self.pos
+
+    def __iter__(self):
+        hole=self.HOLE
+        return (x for x in self.items if not x is hole)
+
+    def __reversed__(self):
+        hole=self.HOLE
+        return (x for x in reversed(self.items) if not x is hole)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,list(self))
+
+    def __getstate__(self):
+        #Never false, else __setstate__ would not be called
+        return (list(self),)
+
+    def __setstate__(self,state):
+        self.__init__(state[0])
+
+
 class Ontology(object):
     """Stores permanent relations between objects of the same type.
 
@@ -70,6 +161,22 @@ class Ontology(object):
         typ (class): type of objects in the ontology.
         edge (dict of dicts):
             edge[i][j] is a list of relations between i and j.
+        redge (dict of dicts):
+            redge[j][i] is a list of relations between i and j (incoming edges).
+        by_type (dict): by_type[e] is a pair of dicts (succ,pred) where succ[i]
+            lists the nodes j with an edge (i,j,e), and pred[j] the nodes i.
+        pair_index (OrderedSet): Pairs (i,j) with at least one edge from i
+            to j.
+        observers (list): Objects whose methods edge_added(i,j,e) and
+            edge_removed(i,j,e) are called after each change of the edges,
+            e.g. ReachabilityIndex, and reset() after changes made
+            elsewhere (see SQLiteDatabase.check).
+        version (int): Incremented whenever nodes or edges are added or
+            removed, e.g. to know when data compiled from the ontology
+            must be compiled again.
+
+    The indexes redge, by_type and pair_index are kept up to date by
+    add_edge and rem_edge.
 
     Relations are directed by default.
     """
@@ -82,16 +189,18 @@ class Ontology(object):
         self.typ=typ
         self.edge={} #dictionary of dictionaries
         self.node={} #dictionary of node attributes
-        self.nodes=[] #list
-        self.edges=[] #list
+        self.nodes=OrderedSet()
+        self.edges=OrderedSet()
         self.skeleton={} #dictionary of sets (existence of edges, undirected and unlabelled)
+        self.redge={}
+        self.by_type={}
+        self.pair_index=OrderedSet()
+        self.observers=[]
+        self.version=0
 
     def pairs(self):
-        pairs=[]
-        for i,j,e in self.edges:
-            if not (i,j) in pairs:
-                pairs.append((i,j))
-        return pairs
+        """Iterate over pairs (i,j) linked by at least one edge from i to j."""
+        return iter(self.pair_index)
 
     def copy(self):
         copy=self.__class__(self.typ)
@@ -114,40 +223,141 @@ class Ontology(object):
                 self.node[i].append(attr)
             else:
                 self.node[i]+=list(attr)
-        self.nodes.append(i)
+        self.nodes.add(i)
+        self.version+=1
 
     def add_node(self,i,*args,**kwargs):
         '''Alias of add.'''
         return self.add(i,*args,**kwargs)
 
+    def add_nodes_from(self,nodes):
+        '''Add nodes from an iterable of uids i or pairs (i,attr), as add.'''
+        edge,node=self.edge,self.node
+        for i in nodes:
+            attr=None
+            if isinstance(i,tuple):
+                i,attr=i
+            if i in self.nodes:
+                continue
+            self.nodes.add(i)
+            self.version+=1
+            edge.setdefault(i,{})
+            node.setdefault(i,[])
+            if not attr is None:
+                if isinstance(attr,basestring):
+                    node[i].append(attr)
+                else:
+                    node[i]+=list(attr)
+
+    def update(self,other):
+        """Add nodes (with attributes) and edges of other, in order."""
+        Ontology.add_nodes_from(self,((n,other.node[n]) for n in other.nodes))
+        Ontology.add_edges_from(self,other.edges)
+
     def add_edge(self,i,j,e='is',reciprocal=False):
         """Add edge of type e between i and j. Directed unless reciprocal==True."""
         if not (i,j,e) in self.edges:
             self.edge.setdefault(i,{}).setdefault(j,[])
             self.edge[i][j]+=[e]
-            self.edges.append((i,j,e))
+            self.edges.add((i,j,e))
+            self.redge.setdefault(j,{}).setdefault(i,[]).append(e)
+            succ,pred=self.by_type.setdefault(e,({},{}))
+            succ.setdefault(i,[]).append(j)
+            pred.setdefault(j,[]).append(i)
+            self.pair_index.add((i,j))
             self.skeleton.setdefault(i,set([])).add(j)
             self.skeleton.setdefault(j,set([])).add(i)
+            self.version+=1
+            for obs in self.observers:
+                obs.edge_added(i,j,e)
         if reciprocal:
             self.add_edge(j,i,e)
 
+    def add_edges_from(self,edges,e='is'):
+        """Add edges from an iterable of triplets (i,j,e) or pairs (i,j) (of
+        type e), as add_edge. The indexes are only updated once all
+        new edges are known, in a single pass."""
+        new=self.edges.update((edge[0],edge[1],e) if len(edge)==2 else tuple(edge)
+            for edge in edges)
+
+        #Create the containers needed by the new edges beforehand, then fill
+        #them in a single pass
+        edge,redge,by_type,skeleton=self.edge,self.redge,self.by_type,self.skeleton
+        sources,targets=set(i for i,j,e in new),set(j for i,j,e in new)
+        for i in sources.difference(edge):
+            edge[i]={}
+        for j in targets.difference(redge):
+            redge[j]={}
+        for i in sources.union(targets).difference(skeleton):
+            skeleton[i]=set([])
+        for e,i in set((e,i) for i,j,e in new):
+            by_type.setdefault(e,({},{}))[0].setdefault(i,[])
+        for e,j in set((e,j) for i,j,e in new):
+            by_type[e][1].setdefault(j,[])
+        pairs=[]
+        for i,j,e in new:
+            out=edge[i]
+            rels=out.get(j)
+            if not rels:
+                pairs.append((i,j))
+                if rels is None:
+                    rels=out[j]=[]
+            rels.append(e)
+            inc=redge[j]
+            if i in inc:
+                inc[i].append(e)
+            else:
+                inc[i]=[e]
+            succ,pred=by_type[e]
+            succ[i].append(j)
+            pred[j].append(i)
+            skeleton[i].add(j)
+            skeleton[j].add(i)
+        self.pair_index.update(pairs)
+        self.version+=len(new)
+        for obs in self.observers:
+            for i,j,e in new:
+                obs.edge_added(i,j,e)
+
 
     def rem_edge(self,i,j,e,reciprocal=True):
         """Removes all edges of type e between i and j, and also between
         j and i unless reciprocal==False."""
         if i in self.edge and j in self.edge[i]:
             [self.edge[i][j].remove(edge) for edge in self.edge[i][j] if edge==e]
-            while (i,j,e) in self.edges:
+            removed=(i,j,e) in self.edges
+            if removed:
                 self.edges.remove((i,j,e))
+                self.unindex_edge(i,j,e)
+            if not self.edge[i][j]:
+                self.pair_index.discard((i,j))
             if not self.edge[i][j] and not self.edge.get(j,{}).get(i,None):
                 if j in self.skeleton[i]:
                     self.skeleton[i].remove(j)
                 if i in self.skeleton[j]:
                     self.skeleton[j].remove(i)
+            if removed:
+                self.version+=1
+                for obs in self.observers:
+                    obs.edge_removed(i,j,e)
         if reciprocal:
             self.rem_edge(j,i,e,reciprocal=False)
 
 
+    def unindex_edge(self,i,j,e):
+        """Remove edge (i,j,e) from redge and by_type."""
+        rels=self.redge[j][i]
+        rels.remove(e)
+        if not rels:
+            del self.redge[j][i]
+        succ,pred=self.by_type[e]
+        for dic,k,l in ((succ,i,j),(pred,j,i)):
+            dic[k].remove(l)
+            if not dic[k]:
+                del dic[k]
+        if not succ:
+            del self.by_type[e]
+
     def get_edges(self,uid1,uid2=None):
         """Get all edges for one element or between two elements"""
         if uid2 is None:
@@ -157,10 +367,42 @@ class Ontology(object):
 
     def nei(self,uid,relation=None):
         '''Find all neighbors of uid (that have a given relation, if specified).'''
+        if not relation is None:
+            for j in self.by_type.get(relation,({},{}))[0].get(uid,()):
+                yield j
+            return
         for i in self.edge.get(uid,{}):
             for etype in self.edge[uid][i]:
-                if relation is None or relation==etype:
-                    yield i
+                yield i
+
+    def pred(self,uid,relation=None):
+        '''Find all nodes with an edge toward uid (with a given relation,
+        if specified).'''
+        if not relation is None:
+            for i in self.by_type.get(relation,({},{}))[1].get(uid,()):
+                yield i
+            return
+        for i in self.redge.get(uid,{}):
+            for etype in self.redge[uid][i]:
+                yield i
+
+    def edges_of_type(self,relation):
+        '''Iterate over edges (i,j,relation).'''
+        succ=self.by_type.get(relation,({},{}))[0]
+        for i in succ:
+            for j in succ[i]:
+                yield i,j,relation
+
+    def adjacent(self,uid,directed=0):
+        '''List of nodes linked to uid by an edge from uid (or in either
+        direction unless directed), or None if uid is not in the graph.'''
+        if directed:
+            graph=self.edge
+        else:
+            graph=self.skeleton
+        if not uid in graph:
+            return None
+        return list(graph[uid])
 
     def paths(self,src,tgt,directed=0,relations=None,maxlen=None):
         '''Find all paths between src and tgt, possibly specifying:
@@ -168,43 +410,500 @@ class Ontology(object):
             set of acceptable relations
             maximum length of path
         NB: Simple depth-first algorithm'''
+        return simple_paths(self,src,tgt,directed,relations,maxlen)
 
-        if directed:
-            graph=self.edge
+    def freeze(self):
+        '''Compact read-only copy of the ontology (see FrozenOntology).'''
+        return FrozenOntology(self)
+
+    def reachability(self,relations):
+        '''ReachabilityIndex for edges of the given types, built on first
+        use and then kept up to date as an observer.'''
+        relations=frozenset(relations)
+        for obs in self.observers:
+            if isinstance(obs,ReachabilityIndex) and obs.relations==relations:
+                return obs
+        index=ReachabilityIndex(self,relations)
+        self.observers.append(index)
+        return index
+
+    def equivalences(self,relations,mutual=()):
+        '''EquivalenceClasses for edges of the given types (and mutual
+        edges of the mutual types), built on first use and then kept up to
+        date as an observer.'''
+        relations,mutual=frozenset(relations),frozenset(mutual)
+        for obs in self.observers:
+            if isinstance(obs,EquivalenceClasses) and (obs.relations,obs.mutual)==(relations,mutual):
+                return obs
+        index=EquivalenceClasses(self,relations,mutual)
+        self.observers.append(index)
+        return index
+
+    def text_index(self):
+        '''TextIndex of the edges, built on first use and then kept up to
+        date as an observer.'''
+        for obs in self.observers:
+            if isinstance(obs,TextIndex):
+                return obs
+        index=TextIndex(self)
+        self.observers.append(index)
+        return index
+
+
+class ReachabilityIndex(object):
+    """Transitive closure of the edges of some types in an ontology,
+    e.g. the types implying inheritance (see Ontology.reachability).
+
+    Attributes:
+        relations (frozenset): Edge types followed.
+        anc (dict): anc[i] is the set of nodes reachable from i through
+            edges of these types (i excluded), e.g. all its categories.
+        desc (dict): desc[j] is the set of nodes from which j is reachable.
+
+    Adding an edge extends the closure of the nodes below it, removing one
+    recomputes the closure of the nodes below it."""
+
+    def __init__(self,ontology,relations):
+        self.ontology=ontology
+        self.relations=frozenset(relations)
+        self.anc={}
+        self.desc={}
+        sources=set(i for rel in self.relations for i,j,e in ontology.edges_of_type(rel))
+        for i in sources:
+            self.set_ancestors(i,self.search(i))
+
+    def search(self,i):
+        '''Nodes reachable from i, found by depth-first search.'''
+        found,stack=set([]),[i]
+        while stack:
+            x=stack.pop()
+            for rel in self.relations:
+                for y in self.ontology.nei(x,rel):
+                    if not y in found:
+                        found.add(y)
+                        stack.append(y)
+        found.discard(i)
+        return found
+
+    def ancestors(self,i):
+        return self.anc.get(i,frozenset())
+
+    def descendants(self,j):
+        return self.desc.get(j,frozenset())
+
+    def lowest_common(self,i,j):
+        '''Nodes reachable from both i and j, from which no other such node
+        is reachable (e.g. the closest categories they share).'''
+        common=self.ancestors(i)&self.ancestors(j)
+        return common-set(a for c in common for a in self.ancestors(c))
+
+    def set_ancestors(self,i,anc):
+        old=self.ancestors(i)
+        for a in old-anc:
+            self.desc[a].discard(i)
+            if not self.desc[a]:
+                del self.desc[a]
+        for a in anc-old:
+            self.desc.setdefault(a,set([])).add(i)
+        if anc:
+            self.anc[i]=anc
         else:
-            graph=self.skeleton
-        if not src in graph or not tgt in graph:
+            self.anc.pop(i,None)
+
+    def edge_added(self,i,j,e):
+        if not e in self.relations:
+            return
+        above=self.ancestors(j)|set([j])
+        for d in list(self.descendants(i))+[i]:
+            anc=self.ancestors(d)
+            if not above<=anc:
+                self.set_ancestors(d,(anc|above)-set([d]))
+
+    def edge_removed(self,i,j,e):
+        if not e in self.relations:
+            return
+        for d in list(self.descendants(i))+[i]:
+            self.set_ancestors(d,self.search(d))
+
+    def reset(self):
+        self.__init__(self.ontology,self.relations)
+
+
+class EquivalenceClasses(object):
+    """Disjoint sets (union-find) of the nodes of an ontology linked by
+    equivalence edges: edges of the given types in either direction, and
+    edges of the mutual types present in both directions (e.g. i is j
+    and j is i). See Ontology.equivalences.
+
+    Attributes:
+        parent (dict): Parent of each node in its tree (absent for roots
+            of single nodes), the root of a tree standing for its class.
+        members (dict): members[root] lists the nodes of the class.
+        rep (dict): rep[root] is the canonical representative of the
+            class, its smallest node.
+
+    Adding an edge merges two classes; removing one marks the classes to
+    be computed again on the next query."""
+
+    def __init__(self,ontology,relations,mutual=()):
+        self.ontology=ontology
+        self.relations=frozenset(relations)
+        self.mutual=frozenset(mutual)
+        self.build()
+
+    def build(self):
+        self.parent,self.members,self.rep={},{},{}
+        self.stale=False
+        for rel in self.relations|self.mutual:
+            for i,j,e in list(self.ontology.edges_of_type(rel)):
+                self.edge_added(i,j,e)
+
+    def find(self,x):
+        '''Root of the tree of x (halving the path to it).'''
+        if self.stale:
+            self.build()
+        parent=self.parent
+        while x in parent:
+            up=parent[x]
+            if up in parent:
+                parent[x]=up=parent[up]
+            x=up
+        return x
+
+    def union(self,i,j):
+        i,j=self.find(i),self.find(j)
+        if i==j:
+            return
+        mi,mj=self.members.get(i,[i]),self.members.get(j,[j])
+        if len(mi)<len(mj):
+            i,j,mi,mj=j,i,mj,mi
+        self.parent[j]=i
+        mi+=mj
+        self.members[i]=mi
+        self.members.pop(j,None)
+        self.rep[i]=min(self.rep.get(i,i),self.rep.pop(j,j))
+
+    def canonical(self,x):
+        '''Canonical representative of the class of x.'''
+        root=self.find(x)
+        return self.rep.get(root,root)
+
+    def equivalents(self,x):
+        '''Nodes of the class of x (including x).'''
+        root=self.find(x)
+        return self.members.get(root,[root])
+
+    def same(self,i,j):
+        return self.find(i)==self.find(j)
+
+    def edge_added(self,i,j,e):
+        if e in self.relations or (e in self.mutual and i in self.ontology.nei(j,e)):
+            if not self.stale:
+                self.union(i,j)
+
+    def edge_removed(self,i,j,e):
+        if e in self.relations or e in self.mutual:
+            self.stale=True
+
+    def reset(self):
+        self.stale=True
+
+
+def simple_paths(graph,src,tgt,directed=0,relations=None,maxlen=None):
+    '''All simple paths between src and tgt in graph (Ontology or
+    FrozenOntology), see Ontology.paths.'''
+    if graph.adjacent(src,directed) is None or graph.adjacent(tgt,directed) is None:
+        return []
+
+    if maxlen is None:
+        maxlen = len(graph.nodes)-1
+    paths=[]
+    visited=[src] #current path
+    neis=[ graph.adjacent(src,directed) ] #neighbors that remain to visit at current step and previous
+    while neis:
+        pocket=neis[-1]
+        if (not pocket) or len(visited)>=maxlen:
+            neis.pop()
+            visited.pop()
+        else:
+            nxt=pocket.pop()
+            if not relations is None:
+                #Skip if bad relation types
+                rels=list(graph.get_edges(visited[-1],nxt))
+                if not directed:
+                    rels+=graph.get_edges(nxt,visited[-1])
+                if not set(relations).intersection(rels):
+                    continue
+            if nxt==tgt:
+                #Stop at this depth
+                paths.append(visited+[tgt] )
+            elif not nxt in visited:
+                #Go deeper
+                visited.append(nxt)
+                neis.append(graph.adjacent(nxt,directed))
+    return paths
+
+
+class TextIndex(object):
+    """Index of the strings found in the edges (i,j,e) of an ontology,
+    by field: 'source' (i), 'target' (j) and 'relation' (e), to find the
+    edges whose field equals, starts with, contains or matches some text
+    (see search).
+
+    Each distinct string of a field is indexed by its n-grams, the string
+    being padded with markers of its start and end, so that prefixes and
+    substrings only need to be compared with the strings containing all
+    of their n-grams. Regular expressions are matched against each
+    distinct string of the field (rather than each edge).
+
+    Attributes:
+        count (dict): count[field][s] is the number of edges with s in field.
+        grams (dict): grams[field][g] is the set of strings of the field
+            containing n-gram g.
+
+    Kept up to date by edge_added and edge_removed (see Ontology.observers)."""
+
+    fields=('source','target','relation')
+    n=3
+    START,END='\x02','\x03'
+
+    def __init__(self,ontology):
+        self.ontology=ontology
+        self.count=dict((field,{}) for field in self.fields)
+        self.grams=dict((field,{}) for field in self.fields)
+        for i,j,e in ontology.edges:
+            self.edge_added(i,j,e)
+
+    def ngrams(self,text):
+        n=self.n
+        return set(text[k:k+n] for k in range(len(text)-n+1))
+
+    def edge_added(self,i,j,e):
+        for field,s in zip(self.fields,(i,j,e)):
+            count=self.count[field]
+            if s in count:
+                count[s]+=1
+                continue
+            count[s]=1
+            grams=self.grams[field]
+            for g in self.ngrams(self.START+s+self.END):
+                grams.setdefault(g,set([])).add(s)
+
+    def edge_removed(self,i,j,e):
+        for field,s in zip(self.fields,(i,j,e)):
+            count=self.count[field]
+            count[s]-=1
+            if count[s]:
+                continue
+            del count[s]
+            grams=self.grams[field]
+            for g in self.ngrams(self.START+s+self.END):
+                grams[g].discard(s)
+                if not grams[g]:
+                    del grams[g]
+
+    def reset(self):
+        self.__init__(self.ontology)
+
+    def keys(self,text,field,rule='strict'):
+        """Strings of the field that match text according to rule:
+        'strict' (equal), 'prefix', 'substring' (or 'inclusive') or 'regex'."""
+        count=self.count[field]
+        if rule=='strict':
+            return [text] if text in count else []
+        if rule=='regex':
+            match=re.compile(text).search
+            return sorted(s for s in count if match(s))
+        if rule=='prefix':
+            grams=self.ngrams(self.START+text)
+            test=lambda s:s.startswith(text)
+        elif rule in ('substring','inclusive'):
+            grams=self.ngrams(text)
+            test=lambda s:text in s
+        else:
+            raise Exception('Unknown search rule: {}'.format(rule))
+        if grams:
+            found=sorted((self.grams[field].get(g,()) for g in grams),key=len)
+            candidates=set(found[0]).intersection(*found[1:])
+        else:
+            #Text shorter than the n-grams
+            candidates=count
+        return sorted(s for s in candidates if test(s))
+
+    def search(self,text,field='any',rule='strict'):
+        """Edges (i,j,e) whose field ('source', 'target', 'relation' or
+        'any' of these) matches text according to rule (see keys),
+        grouped by matching string."""
+        if field=='any':
+            fields=self.fields
+        elif field in self.fields:
+            fields=(field,)
+        else:
+            raise Exception('Unknown search field: {}'.format(field))
+        ont=self.ontology
+        edges,seen=[],set([])
+        for field in fields:
+            for s in self.keys(text,field,rule):
+                if field=='source':
+                    found=((s,j,e) for j,rels in ont.get_edges(s).items() for e in rels)
+                elif field=='target':
+                    found=((i,s,e) for i in OrderedDict.fromkeys(ont.pred(s))
+                        for e in ont.get_edges(i,s))
+                else:
+                    found=ont.edges_of_type(s)
+                for edge in found:
+                    if not edge in seen:
+                        seen.add(edge)
+                        edges.append(edge)
+        return edges
+
+
+class FrozenOntology(object):
+    """Read-only copy of an Ontology using much less memory per edge,
+    for large ontologies. Requires numpy.
+
+    Node uids and edge types are replaced by integer ids, and edges are
+    stored as compressed sparse rows (CSR): the targets of the edges from
+    node k are out_nei[out_ptr[k]:out_ptr[k+1]], and their types the same
+    slice of out_typ. The in_* arrays store incoming edges the same way.
+
+    Attributes:
+        typ (class): type of objects in the ontology.
+        nodes (list): Node uids, indexed by their id.
+        node (dict): Attributes of each node, as in Ontology.
+        types (list): Edge types, indexed by their id.
+
+    Offers the query methods of Ontology (nei, pred, edges_of_type,
+    get_edges, paths)."""
+
+    def __init__(self,ontology):
+        import numpy as np
+        self.typ=ontology.typ
+        self.nodes=list(ontology.nodes)
+        self.node_id=dict((n,k) for k,n in enumerate(self.nodes))
+        self.types=[]
+        self.type_id={}
+        for i,j,e in ontology.edges:
+            for n in (i,j):
+                if not n in self.node_id:
+                    self.node_id[n]=len(self.nodes)
+                    self.nodes.append(n)
+            if not e in self.type_id:
+                self.type_id[e]=len(self.types)
+                self.types.append(e)
+        self.node=dict((n,list(ontology.node.get(n,()))) for n in self.nodes)
+        self.closures={}
+        self.text=None
+        self.version=0
+
+        nedges=len(ontology.edges)
+        src=np.fromiter((self.node_id[i] for i,j,e in ontology.edges),np.int32,nedges)
+        tgt=np.fromiter((self.node_id[j] for i,j,e in ontology.edges),np.int32,nedges)
+        typ=np.fromiter((self.type_id[e] for i,j,e in ontology.edges),np.int32,nedges)
+        self.out_ptr,self.out_nei,self.out_typ=self.csr(src,tgt,typ,len(self.nodes))
+        self.in_ptr,self.in_nei,self.in_typ=self.csr(tgt,src,typ,len(self.nodes))
+
+    @staticmethod
+    def csr(rows,cols,vals,nrows):
+        '''Sort edges by row (keeping their order within each row) and
+        return row offsets, columns and values.'''
+        import numpy as np
+        order=np.argsort(rows,kind='mergesort')
+        ptr=np.zeros(nrows+1,dtype=np.int64)
+        np.cumsum(np.bincount(rows,minlength=nrows),out=ptr[1:])
+        return ptr,cols[order],vals[order]
+
+    @property
+    def edges(self):
+        '''Iterate over edges (i,j,e), grouped by source node.'''
+        for k,i in enumerate(self.nodes):
+            start,end=self.out_ptr[k],self.out_ptr[k+1]
+            for j,e in zip(self.out_nei[start:end],self.out_typ[start:end]):
+                yield i,self.nodes[j],self.types[e]
+
+    def row(self,uid,incoming=False,relation=None):
+        '''Ids of the nodes linked to uid and of the edge types,
+        for outgoing (or incoming) edges, possibly of a given type.'''
+        import numpy as np
+        k=self.node_id.get(uid)
+        if k is None or (relation is not None and not relation in self.type_id):
+            return np.empty(0,np.int32),np.empty(0,np.int32)
+        if incoming:
+            ptr,nei,typ=self.in_ptr,self.in_nei,self.in_typ
+        else:
+            ptr,nei,typ=self.out_ptr,self.out_nei,self.out_typ
+        nei,typ=nei[ptr[k]:ptr[k+1]],typ[ptr[k]:ptr[k+1]]
+        if relation is not None:
+            mask=typ==self.type_id[relation]
+            nei,typ=nei[mask],typ[mask]
+        return nei,typ
+
+    def get_edges(self,uid1,uid2=None):
+        """Get all edges for one element or between two elements"""
+        nei,typ=self.row(uid1)
+        if uid2 is None:
+            edges={}
+            for j,e in zip(nei,typ):
+                edges.setdefault(self.nodes[j],[]).append(self.types[e])
+            return edges
+        if not uid2 in self.node_id:
             return []
-        #paths=self._all_simple_paths_graph(self.skeleton,uid1,uid2)
-
-
-        if maxlen is None:
-            maxlen = len(self.nodes)-1
-        paths=[]
-        visited=[src] #current path
-        neis=[ list(graph[src]) ] #neighbors that remain to visit at current step and previous
-        while neis:
-            pocket=neis[-1]
-            if (not pocket) or len(visited)>=maxlen:
-                neis.pop()
-                visited.pop()
-            else:
-                nxt=pocket.pop()
-                if not relations is None:
-                    #Skip if bad relation types
-                    rels=self.get_edges(visited[-1],nxt)
-                    if not directed:
-                        rels+=self.get_edges(nxt,visited[-1])
-                    if not set(relations).intersection(rels):
-                        continue
-                if nxt==tgt:
-                    #Stop at this depth
-                    paths.append(visited+[tgt] )
-                elif not nxt in visited:
-                    #Go deeper
-                    visited.append(nxt)
-                    neis.append(list(graph[nxt]))
-        return paths
+        return [self.types[e] for e in typ[nei==self.node_id[uid2]]]
+
+    def nei(self,uid,relation=None):
+        '''Find all neighbors of uid (that have a given relation, if specified).'''
+        for j in self.row(uid,relation=relation)[0]:
+            yield self.nodes[j]
+
+    def pred(self,uid,relation=None):
+        '''Find all nodes with an edge toward uid (with a given relation,
+        if specified).'''
+        for j in self.row(uid,incoming=True,relation=relation)[0]:
+            yield self.nodes[j]
+
+    def edges_of_type(self,relation):
+        '''Iterate over edges (i,j,relation), grouped by source node.'''
+        import numpy as np
+        if not relation in self.type_id:
+            return
+        src=np.repeat(np.arange(len(self.nodes)),np.diff(self.out_ptr))
+        mask=self.out_typ==self.type_id[relation]
+        for i,j in zip(src[mask],self.out_nei[mask]):
+            yield self.nodes[i],self.nodes[j],relation
+
+    def adjacent(self,uid,directed=0):
+        '''See Ontology.adjacent.'''
+        import numpy as np
+        if not uid in self.node_id:
+            return None
+        nei=self.row(uid)[0]
+        if not directed:
+            nei=np.concatenate((nei,self.row(uid,incoming=True)[0]))
+        return [self.nodes[j] for j in np.unique(nei)]
+
+    def paths(self,src,tgt,directed=0,relations=None,maxlen=None):
+        '''See Ontology.paths.'''
+        return simple_paths(self,src,tgt,directed,relations,maxlen)
+
+    def reachability(self,relations):
+        '''ReachabilityIndex for edges of the given types.'''
+        relations=frozenset(relations)
+        if not relations in self.closures:
+            self.closures[relations]=ReachabilityIndex(self,relations)
+        return self.closures[relations]
+
+    def equivalences(self,relations,mutual=()):
+        '''EquivalenceClasses for edges of the given types.'''
+        key=(frozenset(relations),frozenset(mutual))
+        if not key in self.closures:
+            self.closures[key]=EquivalenceClasses(self,*key)
+        return self.closures[key]
+
+    def text_index(self):
+        '''TextIndex of the edges.'''
+        if self.text is None:
+            self.text=TextIndex(self)
+        return self.text
 
 class Database(Ontology):
     """Ontology that stores objects in addition to UIDs
@@ -235,10 +934,50 @@ class Database(Ontology):
         self.add(obj2)
         return Ontology.add_edge(self,u1,u2,*args,**kwargs)
 
+    def add_nodes_from(self,nodes):
+        '''Add objects or uids (or pairs (obj,attr)) from an iterable, as add.'''
+        def uids():
+            for obj in nodes:
+                attr=None
+                if isinstance(obj,tuple):
+                    obj,attr=obj
+                if hasattr(obj,'uid'):
+                    self.object[obj.uid]=obj
+                    obj=obj.uid
+                yield obj if attr is None else (obj,attr)
+        Ontology.add_nodes_from(self,uids())
+
+    def add_edges_from(self,edges,e='is'):
+        '''Add edges between objects or uids from an iterable, as add_edge
+        (see Ontology.add_edges_from).'''
+        edges=[tuple(edge) for edge in edges]
+        ends=OrderedSet(obj for edge in edges for obj in edge[:2])
+        self.add_nodes_from(ends)
+        if [obj for obj in ends if hasattr(obj,'uid')]:
+            edges=[(getattr(edge[0],'uid',edge[0]),getattr(edge[1],'uid',edge[1])
+                )+edge[2:] for edge in edges]
+        Ontology.add_edges_from(self,edges,e)
+
+    def update(self,other):
+        """Add nodes, edges, objects and instances of other.
+        Objects already stored for a uid are kept."""
+        Ontology.update(self,other)
+        for uid,obj in other.object.iteritems():
+            self.object.setdefault(uid,obj)
+        for uid,locs in other.instances.iteritems():
+            self.instances.setdefault(uid,set([])).update(locs)
+
     def add_instance(self,obj,location):
         self.instances.setdefault(obj.uid,set([])).add(location)
         self.add(obj)
 
+    def rem_instance(self,obj,location):
+        locs=self.instances.get(obj.uid,())
+        if location in locs:
+            locs.remove(location)
+            if not locs:
+                del self.instances[obj.uid]
+
     def __contains__(self,uid):
         if not isinstance(uid,basestring):
             uid=uid.uid
@@ -255,6 +994,661 @@ class Database(Ontology):
 
 
 
+class LRUCache(object):
+    """Mapping that keeps at most maxsize items, dropping the least
+    recently used ones first. Counts hits and misses of get."""
+
+    def __init__(self,maxsize=1024):
+        self.maxsize=maxsize
+        self.data=OrderedDict()
+        self.hits=self.misses=0
+
+    def get(self,key,default=None):
+        try:
+            val=self.data.pop(key)
+        except KeyError:
+            self.misses+=1
+            return default
+        self.data[key]=val
+        self.hits+=1
+        return val
+
+    def __setitem__(self,key,val):
+        self.data.pop(key,None)
+        self.data[key]=val
+        if len(self.data)>self.maxsize:
+            self.data.popitem(last=False)
+
+    def __contains__(self,key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def pop(self,key,default=None):
+        return self.data.pop(key,default)
+
+    def clear(self):
+        self.data.clear()
+
+
+class SQLiteView(object):
+    """Set or mapping over the contents of a SQLiteDatabase, computed by
+    the given functions: keys() iterates over keys, count() returns their
+    number, contains(key) tests membership and get(key) returns a value
+    (None if absent). Read-only unless set(key,value) is given."""
+
+    def __init__(self,keys,count,contains,get=None,set=None):
+        self.keys,self.count,self.contains,self.getter=keys,count,contains,get
+        self.setter=set
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self,key):
+        return self.contains(key)
+
+    def get(self,key,default=None):
+        val=self.getter(key)
+        if val is None:
+            return default
+        return val
+
+    def __getitem__(self,key):
+        val=self.getter(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self,key,val):
+        if self.setter is None:
+            raise Exception('Read-only view')
+        self.setter(key,val)
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key,self.getter(key)
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class SQLiteEdgeView(SQLiteView):
+    """View of the edges of a SQLiteDatabase, with positional access
+    as for the edges of an Ontology."""
+
+    def __init__(self,db):
+        SQLiteView.__init__(self,db.iter_edges,lambda:db.count('edges'),db.has_edge)
+        self.db=db
+
+    def index(self,edge):
+        return self.db.edge_index(edge)
+
+    def insert(self,index,edge):
+        self.db.insert_edge(index,edge)
+
+
+class SQLiteDatabase(Database):
+    """Database stored in a SQLite file rather than in memory, for large
+    ontologies shared between files and editor processes. Several
+    SQLiteDatabases (e.g. of atoms and nodes) can share the same file.
+
+    Nodes (with their attributes and objects), edges and instances are
+    stored in tables indexed by uid. Queries (get_edges, nei, pred,
+    edges_of_type, __contains__...) are run in SQL, and the adjacency
+    and attributes of recently used uids are kept in an LRU cache.
+    The attributes nodes, edges, node, edge and instances are views over
+    the tables, which can be used as those of a Database (only instances
+    can be assigned to).
+
+    Objects are stored pickled, and each is only unpickled once per
+    process, so that a uid always gives the same object as in Database.
+    Instance locations are stored as text (see location_key), and mapped
+    back to the locations added in this process (other locations are
+    given as text). They belong to a scope (e.g. the file they were parsed
+    from), and only those of its own scope are seen by a SQLiteDatabase,
+    while nodes and edges are shared.
+    Changes are committed by bulk additions, commit() and close(),
+    and before pickling (which stores the path of the file, along with
+    the objects and locations of this process, so that they remain the
+    same objects as those pickled with them).
+    SQLiteDatabases using the same file in a thread share one connection,
+    and each thread uses its own. Those using the same tables in a thread
+    also share their cache, observers and count of changes (see tables),
+    so that changes made through one of them are seen by all.
+
+    Changes committed to the file by other connections (e.g. other
+    editors) are detected by check, called by version: cached data is
+    then dropped and the observers are reset."""
+
+    connections={} #By path and thread
+    tables={} #Shared state of the tables of each type, by path, type and thread
+
+    schema='''
+    CREATE TABLE IF NOT EXISTS {t}_nodes (id INTEGER PRIMARY KEY,
+        uid TEXT UNIQUE NOT NULL, attr BLOB, obj BLOB);
+    CREATE TABLE IF NOT EXISTS {t}_edges (pos REAL NOT NULL,
+        src TEXT NOT NULL, tgt TEXT NOT NULL, typ TEXT NOT NULL,
+        PRIMARY KEY (src,tgt,typ));
+    CREATE INDEX IF NOT EXISTS {t}_edges_tgt ON {t}_edges (tgt,typ);
+    CREATE INDEX IF NOT EXISTS {t}_edges_typ ON {t}_edges (typ);
+    CREATE INDEX IF NOT EXISTS {t}_edges_pos ON {t}_edges (pos);
+    CREATE TABLE IF NOT EXISTS {t}_instances (scope TEXT NOT NULL,
+        uid TEXT NOT NULL, loc TEXT NOT NULL, PRIMARY KEY (scope,uid,loc));
+    '''
+
+    scope=''
+
+    def __init__(self,typ,path,cache_size=4096,scope=''):
+        self.typ=typ
+        self.path=str(path)
+        self.cache_size=cache_size
+        self.scope=scope
+        self.connect()
+
+    @property
+    def conn(self):
+        """Connection to the file for the current thread."""
+        import sqlite3,thread
+        key=(self.path,thread.get_ident())
+        conn=self.connections.get(key)
+        if conn is None:
+            conn=self.connections[key]=sqlite3.connect(self.path,timeout=60)
+            conn.text_factory=str
+        return conn
+
+    @property
+    def table(self):
+        """State shared by the SQLiteDatabases using the tables of this type
+        in the current thread: cache (LRUCache), observers, changes made
+        (the first part of version) and data_version (of the connection)."""
+        import thread
+        key=(self.path,self.typ,thread.get_ident())
+        table=self.tables.get(key)
+        if table is None:
+            table=self.tables[key]={'cache':LRUCache(self.cache_size),
+                'observers':[],'changes':0,'data_version':None}
+        return table
+
+    @property
+    def cache(self):
+        return self.table['cache']
+
+    @property
+    def observers(self):
+        return self.table['observers']
+
+    @property
+    def changes(self):
+        return self.table['changes']
+
+    @changes.setter
+    def changes(self,value):
+        self.table['changes']=value
+
+    def connect(self):
+        columns=[r[1] for r in self.sql('PRAGMA table_info({t}_instances)')]
+        if columns and not 'scope' in columns:
+            #Instances stored before they were scoped, found again by parsing
+            self.sql('DROP TABLE {t}_instances')
+        self.conn.executescript(self.schema.format(t=self.typ))
+        self.object={} #Objects unpickled or added in this process
+        self.located={} #Instance locations added in this process, by key
+        self.check()
+        self.nodes=SQLiteView(lambda:(r[0] for r in self.sql('SELECT uid FROM {t}_nodes ORDER BY id')),
+            lambda:self.count('nodes'),self.has_node)
+        self.node=SQLiteView(self.nodes.keys,self.nodes.count,self.has_node,self.get_attr)
+        self.edge=SQLiteView(self.nodes.keys,self.nodes.count,self.has_node,
+            lambda uid:self.get_edges(uid) if self.has_node(uid) else None)
+        self.edges=SQLiteEdgeView(self)
+        self.instances=SQLiteView(
+            lambda:(r[0] for r in self.sql('SELECT DISTINCT uid FROM {t}_instances WHERE scope=?',
+                self.scope)),
+            lambda:self.sql('SELECT count(DISTINCT uid) FROM {t}_instances WHERE scope=?',
+                self.scope).fetchone()[0],
+            lambda uid:bool(self.sql('SELECT 1 FROM {t}_instances WHERE scope=? AND uid=?',
+                self.scope,uid).fetchone()),
+            lambda uid:set(self.located.get(r[0],r[0]) for r in
+                self.sql('SELECT loc FROM {t}_instances WHERE scope=? AND uid=?',self.scope,uid))
+                or None,
+            self.set_instances)
+
+    def sql(self,query,*args):
+        return self.conn.execute(query.format(t=self.typ),args)
+
+    def check(self):
+        """Drop cached data and reset the observers if other connections
+        committed changes to the file since the last check. Returns True
+        if so."""
+        table=self.table
+        version=self.sql('PRAGMA data_version').fetchone()[0]
+        if version==table['data_version']:
+            return False
+        changed=table['data_version'] is not None
+        table['data_version']=version
+        if changed:
+            self.cache.clear()
+            for obs in self.observers:
+                obs.reset()
+        return changed
+
+    @property
+    def version(self):
+        '''Changes made here, and changes committed by other connections
+        to the file (as counted by SQLite).'''
+        self.check()
+        return (self.changes,self.table['data_version'])
+
+    def count(self,table):
+        return self.sql('SELECT count(*) FROM {t}_'+table).fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        """Commit and close the file (for all SQLiteDatabases using it in
+        this thread)."""
+        import thread
+        self.conn.commit()
+        self.conn.close()
+        ident=thread.get_ident()
+        self.connections.pop((self.path,ident),None)
+        for key in [k for k in self.tables if k[0]==self.path and k[2]==ident]:
+            del self.tables[key]
+
+    def __getstate__(self):
+        self.commit()
+        return {'typ':self.typ,'path':self.path,'cache_size':self.cache_size,
+            'scope':self.scope,'object':self.object,'located':self.located}
+
+    def __setstate__(self,state):
+        object,located=state.pop('object',{}),state.pop('located',{})
+        self.__dict__.update(state)
+        self.connect()
+        self.object.update(object)
+        self.located.update(located)
+
+    def forget(self,*uids):
+        """Drop cached data about uids, after they were modified."""
+        self.changes+=1
+        for uid in uids:
+            for kind in ('out','attr','node'):
+                self.cache.pop((kind,uid))
+
+    @staticmethod
+    def location_key(location):
+        """Text identifying an instance location by the uids of its elements."""
+        if isinstance(location,tuple):
+            return repr(tuple(getattr(x,'uid',x) for x in location))
+        return repr(getattr(location,'uid',location))
+
+    @staticmethod
+    def dumps(val):
+        import cPickle as pickle,sqlite3
+        return sqlite3.Binary(pickle.dumps(val,pickle.HIGHEST_PROTOCOL))
+
+    #Nodes
+
+    def has_node(self,uid):
+        known=self.cache.get(('node',uid))
+        if known is None:
+            known=bool(self.sql('SELECT 1 FROM {t}_nodes WHERE uid=?',uid).fetchone())
+            self.cache[('node',uid)]=known
+        return known
+
+    def get_attr(self,uid):
+        import cPickle as pickle
+        attr=self.cache.get(('attr',uid))
+        if attr is None:
+            row=self.sql('SELECT attr FROM {t}_nodes WHERE uid=?',uid).fetchone()
+            if row is None:
+                return None
+            attr=pickle.loads(str(row[0]))
+            self.cache[('attr',uid)]=attr
+        return attr
+
+    def add(self,obj,attr=None):
+        uid=getattr(obj,'uid',obj)
+        if uid in self.object:
+            return
+        if hasattr(obj,'uid'):
+            self.object[uid]=obj
+        if self.has_node(uid):
+            if hasattr(obj,'uid'):
+                self.sql('UPDATE {t}_nodes SET obj=? WHERE uid=? AND obj IS NULL',
+                    self.dumps(obj),uid)
+            return
+        if attr is None:
+            attr=[]
+        elif isinstance(attr,basestring):
+            attr=[attr]
+        self.sql('INSERT INTO {t}_nodes (uid,attr,obj) VALUES (?,?,?)',uid,
+            self.dumps(list(attr)),self.dumps(obj) if hasattr(obj,'uid') else None)
+        self.forget(uid)
+
+    def add_nodes_from(self,nodes):
+        rows=[]
+        for obj in nodes:
+            attr=None
+            if isinstance(obj,tuple):
+                obj,attr=obj
+            if attr is None:
+                attr=[]
+            elif isinstance(attr,basestring):
+                attr=[attr]
+            uid=getattr(obj,'uid',obj)
+            if hasattr(obj,'uid'):
+                self.object[uid]=obj
+            rows.append((uid,self.dumps(list(attr)),
+                self.dumps(obj) if hasattr(obj,'uid') else None))
+        self.conn.executemany('INSERT OR IGNORE INTO {}_nodes (uid,attr,obj) VALUES (?,?,?)'.format(
+            self.typ),rows)
+        self.cache.clear()
+        self.changes+=1
+        self.commit()
+
+    def __contains__(self,uid):
+        uid=getattr(uid,'uid',uid)
+        if uid in self.object:
+            return True
+        return bool(self.sql('SELECT 1 FROM {t}_nodes WHERE uid=? AND obj IS NOT NULL',
+            uid).fetchone())
+
+    def __getitem__(self,uid):
+        import cPickle as pickle
+        if uid in self.object:
+            return self.object[uid]
+        row=self.sql('SELECT obj FROM {t}_nodes WHERE uid=?',uid).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError(uid)
+        obj=self.object[uid]=pickle.loads(str(row[0]))
+        return obj
+
+    def get(self,uid,default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    #Edges
+
+    def iter_edges(self,relation=None):
+        if relation is None:
+            rows=self.sql('SELECT src,tgt,typ FROM {t}_edges ORDER BY pos')
+        else:
+            rows=self.sql('SELECT src,tgt,typ FROM {t}_edges WHERE typ=? ORDER BY pos',relation)
+        for row in rows:
+            yield row
+
+    def has_edge(self,edge):
+        return bool(self.sql('SELECT 1 FROM {t}_edges WHERE src=? AND tgt=? AND typ=?',
+            *edge).fetchone())
+
+    def edge_pos(self,edge):
+        row=self.sql('SELECT pos FROM {t}_edges WHERE src=? AND tgt=? AND typ=?',*edge).fetchone()
+        if row is None:
+            raise ValueError('{} is not in {} edges'.format(edge,self.typ))
+        return row[0]
+
+    def edge_index(self,edge):
+        return self.sql('SELECT count(*) FROM {t}_edges WHERE pos<?',
+            self.edge_pos(edge)).fetchone()[0]
+
+    def insert_edge(self,index,edge):
+        """Move or add edge to position index in the order of edges."""
+        i,j,e=edge
+        self.add(i)
+        self.add(j)
+        existed=self.sql('DELETE FROM {t}_edges WHERE src=? AND tgt=? AND typ=?',*edge).rowcount
+        around=[r[0] for r in self.sql('SELECT pos FROM {t}_edges ORDER BY pos LIMIT 2 OFFSET ?',
+            max(index-1,0))]
+        if not around:
+            pos=self.next_pos()
+        elif index==0:
+            pos=around[0]-1
+        elif len(around)==1:
+            pos=around[0]+1
+        else:
+            pos=(around[0]+around[1])/2.
+        self.sql('INSERT INTO {t}_edges (pos,src,tgt,typ) VALUES (?,?,?,?)',pos,i,j,e)
+        self.forget(i,j)
+        if not existed:
+            for obs in self.observers:
+                obs.edge_added(i,j,e)
+
+    def next_pos(self):
+        return (self.sql('SELECT max(pos) FROM {t}_edges').fetchone()[0] or 0)+1
+
+    def add_edge(self,obj1,obj2,e='is',reciprocal=False):
+        self.add(obj1)
+        self.add(obj2)
+        i,j=getattr(obj1,'uid',obj1),getattr(obj2,'uid',obj2)
+        if not self.has_edge((i,j,e)):
+            self.sql('INSERT INTO {t}_edges (pos,src,tgt,typ) VALUES (?,?,?,?)',
+                self.next_pos(),i,j,e)
+            self.forget(i,j)
+            for obs in self.observers:
+                obs.edge_added(i,j,e)
+        if reciprocal:
+            self.add_edge(j,i,e)
+
+    def add_edges_from(self,edges,e='is'):
+        edges=[(edge[0],edge[1],e) if len(edge)==2 else tuple(edge) for edge in edges]
+        self.add_nodes_from(OrderedSet(obj for edge in edges for obj in edge[:2]))
+        edges=[(getattr(i,'uid',i),getattr(j,'uid',j),e) for i,j,e in edges]
+        if self.observers:
+            new=[edge for edge in OrderedSet(edges) if not self.has_edge(edge)]
+        start=self.next_pos()
+        self.conn.executemany('INSERT OR IGNORE INTO {}_edges (pos,src,tgt,typ) VALUES (?,?,?,?)'.format(
+            self.typ),((start+k,i,j,e) for k,(i,j,e) in enumerate(edges)))
+        self.cache.clear()
+        self.changes+=1
+        self.commit()
+        for obs in self.observers:
+            for edge in new:
+                obs.edge_added(*edge)
+
+    def rem_edge(self,i,j,e,reciprocal=True):
+        if self.sql('DELETE FROM {t}_edges WHERE src=? AND tgt=? AND typ=?',i,j,e).rowcount:
+            self.forget(i,j)
+            for obs in self.observers:
+                obs.edge_removed(i,j,e)
+        if reciprocal:
+            self.rem_edge(j,i,e,reciprocal=False)
+
+    def get_edges(self,uid1,uid2=None):
+        """Get all edges for one element or between two elements
+        (the dictionary returned for one element must not be modified)."""
+        edges=self.cache.get(('out',uid1))
+        if edges is None:
+            edges={}
+            for j,e in self.sql('SELECT tgt,typ FROM {t}_edges WHERE src=? ORDER BY pos',uid1):
+                edges.setdefault(j,[]).append(e)
+            self.cache[('out',uid1)]=edges
+        if uid2 is None:
+            return edges
+        return list(edges.get(uid2,[]))
+
+    def nei(self,uid,relation=None):
+        if relation is None:
+            edges=self.get_edges(uid)
+            return (j for j in edges for e in edges[j])
+        return (r[0] for r in self.sql('SELECT tgt FROM {t}_edges WHERE src=? AND typ=? ORDER BY pos',
+            uid,relation))
+
+    def pred(self,uid,relation=None):
+        if relation is None:
+            rows=self.sql('SELECT src FROM {t}_edges WHERE tgt=? ORDER BY pos',uid)
+        else:
+            rows=self.sql('SELECT src FROM {t}_edges WHERE tgt=? AND typ=? ORDER BY pos',
+                uid,relation)
+        return (r[0] for r in rows)
+
+    def edges_of_type(self,relation):
+        return self.iter_edges(relation)
+
+    def pairs(self):
+        return iter(self.sql('SELECT src,tgt FROM {t}_edges GROUP BY src,tgt ORDER BY min(pos)'
+            ).fetchall())
+
+    def adjacent(self,uid,directed=0):
+        if not self.has_node(uid):
+            return None
+        if directed:
+            return list(self.get_edges(uid))
+        return [r[0] for r in self.sql('SELECT tgt FROM {t}_edges WHERE src=? UNION '
+            'SELECT src FROM {t}_edges WHERE tgt=?',uid,uid)]
+
+    #Instances and other Databases
+
+    def add_instance(self,obj,location):
+        key=self.location_key(location)
+        self.located[key]=location
+        self.sql('INSERT OR IGNORE INTO {t}_instances (scope,uid,loc) VALUES (?,?,?)',
+            self.scope,obj.uid,key)
+        self.add(obj)
+
+    def set_instances(self,uid,locations):
+        """Replace the instance locations of uid (as assigning to
+        instances[uid] in a Database)."""
+        keys=[]
+        for loc in locations:
+            key=self.location_key(loc)
+            self.located[key]=loc
+            keys.append(key)
+        self.sql('DELETE FROM {t}_instances WHERE scope=? AND uid=?',self.scope,uid)
+        self.conn.executemany('INSERT OR IGNORE INTO {}_instances (scope,uid,loc) VALUES (?,?,?)'.format(
+            self.typ),((self.scope,uid,key) for key in keys))
+        self.changes+=1
+
+    def rem_instance(self,obj,location):
+        self.sql('DELETE FROM {t}_instances WHERE scope=? AND uid=? AND loc=?',self.scope,obj.uid,
+            self.location_key(location))
+
+    def clear_instances(self):
+        """Remove all instances of the scope (e.g. before parsing its file
+        again)."""
+        self.sql('DELETE FROM {t}_instances WHERE scope=?',self.scope)
+        self.changes+=1
+
+    def update(self,other):
+        """Add nodes, edges, objects and instances of other (a Database
+        in memory, or stored in another file)."""
+        if isinstance(other,SQLiteDatabase) and (other.path,other.typ,other.scope)==(
+                self.path,self.typ,self.scope):
+            return
+        self.add_nodes_from((n,other.node[n]) for n in other.nodes)
+        self.add_edges_from(other.edges)
+        self.conn.executemany('UPDATE {}_nodes SET obj=? WHERE uid=? AND obj IS NULL'.format(
+            self.typ),((self.dumps(obj),uid) for uid,obj in other.object.iteritems()))
+        for uid,obj in other.object.iteritems():
+            self.object.setdefault(uid,obj)
+        rows=[]
+        for uid,locs in other.instances.iteritems():
+            for loc in locs:
+                key=self.location_key(loc)
+                if isinstance(loc,basestring) and isinstance(other,SQLiteDatabase):
+                    #Location of another process, already a key
+                    key=loc
+                else:
+                    self.located[key]=loc
+                rows.append((self.scope,uid,key))
+        self.conn.executemany('INSERT OR IGNORE INTO {}_instances (scope,uid,loc) VALUES (?,?,?)'.format(
+            self.typ),rows)
+        self.cache.clear()
+        self.changes+=1
+        self.commit()
+
+    def copy(self):
+        """Copy of the ontology in memory (as a Database)."""
+        copy=Database(self.typ)
+        copy.update(self)
+        return copy
+
+    def freeze(self):
+        return FrozenOntology(self)
+
+
+class ExclusionTable(object):
+    """Pairs of atoms that exclude each other according to a QueryHandler
+    (see QueryHandler.get_relations), compiled from its database: atoms
+    whose closest shared categories include one whose inner relations
+    include 'exclude' (e.g. an 'exclusive' category, see
+    OntologyRuleset.inner_relation), unless one inherits from the other,
+    and atoms with 'exclude' edges between them or between their
+    categories.
+
+    Attributes:
+        categories (dict): categories[a] is the set of exclusive
+            categories that atom a belongs to.
+        left, right (dict): Sets of exclude edges, such that there is an
+            edge from a category of atom a (or a) to one of atom b (or b)
+            iff left[a] and right[b] intersect.
+        reach (ReachabilityIndex): Categories of each atom.
+        version: Version of the database the table was compiled from."""
+
+    def __init__(self,query):
+        dbs=query.database
+        self.version=dbs.version
+        self.categories,self.left,self.right={},{},{}
+        reach=self.reach=dbs.reachability(query.rule.get_types('inherit'))
+        for cat in list(reach.desc):
+            if 'exclude' in query.rule.inner_relation(dbs.node.get(cat,[])):
+                for i in reach.descendants(cat):
+                    self.categories.setdefault(i,set([])).add(cat)
+        for i,j,e in dbs.edges_of_type('exclude'):
+            if i==j:
+                continue
+            for x in reach.descendants(i)|set([i]):
+                self.left.setdefault(x,set([])).add((i,j))
+            for y in reach.descendants(j)|set([j]):
+                self.right.setdefault(y,set([])).add((i,j))
+
+    def excludes(self,a,b):
+        """True if distinct atoms a and b exclude each other, i.e. if
+        'exclude' is in QueryHandler.get_relations(a,b)."""
+        left,right=self.left.get(a),self.right.get(b)
+        if left and right and not left.isdisjoint(right):
+            return True
+        cats,others=self.categories.get(a),self.categories.get(b)
+        if not (cats and others) or cats.isdisjoint(others):
+            return False
+        reach=self.reach
+        if b in reach.ancestors(a) or a in reach.ancestors(b):
+            return False
+        return not cats.isdisjoint(reach.lowest_common(a,b))
+
+    def excluded(self,atom,others):
+        """Those of others (distinct from atom) that atom excludes."""
+        if not (atom in self.left or atom in self.categories):
+            return []
+        return [o for o in others if o!=atom and self.excludes(atom,o)]
+
+
+def memoized(method):
+    """Decorator storing the results of a QueryHandler method in its cache,
+    keyed by the arguments and the versions of the databases involved (the
+    handler's and any given as argument), so that any change to these
+    databases makes older results unreachable. Callers get a copy."""
+    name=method.__name__
+    @wraps(method)
+    def wrapper(self,*args,**kwargs):
+        dbs=(self.database,self.relation_db)+tuple(a for a in args if hasattr(a,'version'))
+        key=(name,args,tuple(sorted(kwargs.items())),tuple(db.version for db in dbs))
+        try:
+            res=self.cache.get(key,wrapper)
+        except TypeError:
+            #Unhashable arguments
+            return method(self,*args,**kwargs)
+        if res is wrapper:
+            res=self.cache[key]=method(self,*args,**kwargs)
+        return copy(res)
+    return wrapper
+
+
 class QueryHandler(object):
     """Allows intelligent querying of a database using a ruleset for inference.
 
@@ -264,11 +1658,14 @@ class QueryHandler(object):
             inference on the database.
         relation_db (Ontology): Optional, distinct database for relations between
             (atoms representing) relation types.
+        cache (LRUCache): Results of get_relations, get_equivalents and
+            get_parents (see memoized), with hit and miss counts.
 
         ."""
 
+    cache_size=65536
 
-    def __init__(self,database,rule=None,relation_db=None):
+    def __init__(self,database,rule=None,relation_db=None,cache_size=None):
         self.database=database
         if rule is None:
             rule=DefaultOntologyRuleset()
@@ -279,12 +1676,27 @@ class QueryHandler(object):
         else:
             #Relatiosn between relations are stored externally
             self.relation_db=relation_db
+        self.exclusion_table=None
+        self.cache=LRUCache(cache_size or self.cache_size)
 
-    def filter(self,text,field='any',rule='strict'):
-        """filter"""
-        edges=list(self.database.edges)
+    def cache_info(self):
+        """Hits, misses and current size of the result cache."""
+        return {'hits':self.cache.hits,'misses':self.cache.misses,
+            'size':len(self.cache),'maxsize':self.cache.maxsize}
 
-        return edges
+    def exclusions(self):
+        """ExclusionTable of the database, compiled again whenever the
+        database has changed since the last call."""
+        table=self.exclusion_table
+        if table is None or table.version!=self.database.version:
+            table=self.exclusion_table=ExclusionTable(self)
+        return table
+
+    def filter(self,text,field='any',rule='strict'):
+        """Edges of the database whose field ('source', 'target', 'relation'
+        or 'any') matches text according to rule ('strict', 'prefix',
+        'substring' or 'regex'), found through its TextIndex."""
+        return self.database.text_index().search(text,field,rule)
 
     def get_neighbors(self,uid,relation=None,strict=True,is_relation=False):
         '''Find neighbors to element with given uid, filtered by relation type
@@ -296,11 +1708,11 @@ class QueryHandler(object):
             dbs=self.relation_db
         if strict:
             '''Find only neighbors with specified relation'''
-            return dbs.get_nei(uid,relation)
+            return list(dbs.nei(uid,relation))
         else:
             '''Find neighbors with equivalent relation'''
             #If relation is a primary relation type of the ontology ruleset (e.g. exclude)
-            types=self.rule.get_types(relation,is_relation=True)
+            types=self.rule.get_types(relation)
             if not types:
                 types=self.get_equivalents(relation)
             neis=[]
@@ -308,54 +1720,87 @@ class QueryHandler(object):
                 neis+=self.get_neighbors(uid,t,strict=True,is_relation=is_relation)
             return neis
 
+    @memoized
     def get_relations(self,uid1,uid2,strict=False,is_relation=False):
         '''Find all relations between uid1 and uid2, including indirect ones
-        unless strict=True'''
+        unless strict=True: relations from a category of uid1 to a category
+        of uid2, and the inner relations of the closest categories they
+        both belong to (see OntologyRuleset.inner_relation and
+        ReachabilityIndex.lowest_common) unless one of them inherits from
+        the other, where the categories of a node are the nodes it inherits
+        from (through edges of type 'inherit', transitively). Each relation
+        is only listed once.'''
         if not is_relation:
             dbs=self.database
         else:
             dbs=self.relation_db
 
-        #Find all paths between the two nodes
-        rule=self.rule
-        inherit=set(rule.get_types('inherit'))
-        paths=dbs.paths(uid1,uid2)
         relations=list(dbs.get_edges(uid1,uid2))
-        for path in paths:
-            cur=list(path)
-            if len(cur)==2:
-                continue
-            #Via inheritance, reduce the path from both ends
-            while len(cur)>=2 and inherit.intersection(dbs.get_edges(cur[0],cur[1]) ) :
-                    cur=cur[1:]
-            while len(cur)>=2 and inherit.intersection(dbs.get_edges(cur[-1],cur[-2]) ) :
-                cur=cur[:-1]
-            newrel=[]
-            if len(cur)==2:
-                #Relation between parent categories
-                newrel=list(dbs.get_edges(uid1,uid2))
-            elif len(cur)==1:
+        if strict:
+            return relations
+        inherit=set(self.rule.get_types('inherit'))
+        reach=dbs.reachability(inherit)
+        anc1,anc2=reach.ancestors(uid1),reach.ancestors(uid2)
+        newrel=[]
+        for cat in [uid1]+list(anc1):
+            edges=dbs.get_edges(cat)
+            for other in edges:
+                if other!=cat and (other in anc2 or other==uid2 and cat!=uid1):
+                    #Relation between parent categories
+                    newrel+=[e for e in edges[other] if not e in inherit]
+        if not (uid2 in anc1 or uid1 in anc2):
+            for cat in reach.lowest_common(uid1,uid2):
                 #Relation between two tokens of the same category
-                newrel=rule.inner_relation(dbs.node[cur[0]])
-            relations+= newrel
-            print 'QueryHandler.get_relations: reduced path between',uid1,uid2,cur, newrel
+                newrel+=self.rule.inner_relation(dbs.node.get(cat,[]))
+        for e in newrel:
+            if not e in relations:
+                relations.append(e)
         return relations
 
+    def equivalences(self,is_relation=False):
+        '''EquivalenceClasses of the database (or relation_db): edges of the
+        equivalence types of the ruleset, and mutual edges of the types
+        implied by rule 'is'. This is the observer kept up to date by the
+        database itself (not a copy), so that it is only rebuilt once after
+        an edge is removed.'''
+        if not is_relation:
+            dbs=self.database
+        else:
+            dbs=self.relation_db
+        symmetric=self.rule.equivalence_types
+        return dbs.equivalences(symmetric,
+            [t for t in self.rule.get_types('is') if not t in symmetric])
+
+    def canonical(self,uid,is_relation=False):
+        '''Canonical representative of the atoms equivalent to uid.'''
+        return self.equivalences(is_relation).canonical(uid)
+
+    @memoized
     def get_equivalents(self, uid,is_relation=False):
-        '''Find all atoms that are equivalent to a given atom.'''
-        equi=[uid]+self.get_neighbors(uid,'is',strict=False, is_relation=is_relation)
-        return equi
+        '''Find all atoms that are equivalent to a given atom (uid first).'''
+        equi=self.equivalences(is_relation).equivalents(uid)
+        return [uid]+[x for x in equi if x!=uid]
+
+    def get_instances(self,uid):
+        '''Locations of the instances of uid and of its equivalents.'''
+        locs=set([])
+        for x in self.equivalences().equivalents(uid):
+            locs.update(self.database.instances.get(x,()))
+        return locs
 
 
+    @memoized
     def get_parents(self,db,uid,recursive=True):
         """Returns all object uids corresponding to parents of the given uid.
         If recursive, adds all further ancestors as well."""
-        parent_types=set(self.ruleset.get_types('parent'))
+        parent_types=set(self.rule.get_types('parent'))
         parents=set([])
-        edges=db.get_edges(uid)
-        for j in edges:
-            if parent_types.intersection(edges[j]):
-                parents.add(j)
-                if recursive:
-                    parents.union(self.get_parents(j))
+        todo=[uid]
+        while todo:
+            edges=db.get_edges(todo.pop())
+            for j in edges:
+                if not j in parents and parent_types.intersection(edges[j]):
+                    parents.add(j)
+                    if recursive:
+                        todo.append(j)
         return parents
\ No newline at end of file
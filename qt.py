@@ -245,6 +245,8 @@ class Ui_MainWindow(object):
         self.onto_search_rule.setObjectName(_fromUtf8("onto_search_rule"))
         self.onto_search_rule.addItem(_fromUtf8(""))
         self.onto_search_rule.addItem(_fromUtf8(""))
+        self.onto_search_rule.addItem(_fromUtf8(""))
+        self.onto_search_rule.addItem(_fromUtf8(""))
         self.horizontalLayout_10.addWidget(self.onto_search_rule)
         self.horizontalLayout_10.setStretch(2, 2)
         self.horizontalLayout_10.setStretch(4, 1)
@@ -329,6 +331,8 @@ class Ui_MainWindow(object):
         self.label_15.setText(_translate("MainWindow", "Rule:", None))
         self.onto_search_rule.setItemText(0, _translate("MainWindow", "Strict", None))
         self.onto_search_rule.setItemText(1, _translate("MainWindow", "Inclusive", None))
+        self.onto_search_rule.setItemText(2, _translate("MainWindow", "Prefix", None))
+        self.onto_search_rule.setItemText(3, _translate("MainWindow", "Regex", None))
         self.onto_table.setSortingEnabled(True)
         self.onto_table.headerItem().setText(0, _translate("MainWindow", "Source", None))
         self.onto_table.headerItem().setText(1, _translate("MainWindow", "Target", None))
@@ -13,18 +13,20 @@ from qtext import *
 
 
 class Editor(QtGui.QMainWindow):
-    SAVES=0
-    MAXSAVES=100
+    MAXUNDO=100
+    AUTOSAVE_DELAY=2. #Seconds without edits before saving
+    JOURNAL_SIZE=1<<20 #Bytes of journal before compaction
     block_changes=0
     _focused=None
     log_path='./logs'
     backup_path='./logs'
+    cache_path='./logs/cache'
+    shared_db=None #SQLite file for atom and node ontologies shared between files
 
     def __init__(self, parent=None,**kwargs):
         self.sequences=[] #Data
 
-        self.undo_stack=[]
-        self.redo_stack=[]
+        self.history=EditHistory(self.MAXUNDO)
 
         #QT
         QtGui.QWidget.__init__(self, parent)
@@ -38,9 +40,24 @@ class Editor(QtGui.QMainWindow):
 
         Path(self.log_path).mkdir()
         Path(self.backup_path).mkdir()
+        self.parse_cache=ParseCache(self.cache_path)
+        self.autosave=Autosave(Path(self.backup_path)+'autosave.dat',
+            self.autosave_export,lambda:self.history.version,
+            delay=self.AUTOSAVE_DELAY)
+        #Checks on this thread whether edits have stopped; data is exported
+        #and written in the background
+        self.autosave_timer=QtCore.QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave.poll)
+        self.autosave_timer.start(500)
+
+        #Watching files for changes made outside the editor
+        self.watcher=QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.file_changed)
+        self.saved_mtime={}
+        self.journal=None
 
         #try:
-        if 1:
+        if not (self.autosave.exists() and self.recover_autosave()):
             for l in open(Path(self.log_path)+'.last','r'):
                 if not l.strip():
                     continue
@@ -60,6 +77,28 @@ class Editor(QtGui.QMainWindow):
         ui.actionLoad.setShortcut("Ctrl+L")
 
 
+    def autosave_export(self):
+        """Text of the data, exported by the autosave thread."""
+        handler=self.iohandler.reader()
+        try:
+            return list(handler.iter_export(self.sequences))
+        finally:
+            handler.close()
+
+    def recover_autosave(self):
+        """Offer to open the data autosaved in a session that ended without
+        saving it. Returns True if it was opened."""
+        import shutil
+        answer=QtGui.QMessageBox.question(self,'Recover autosave',
+            'Some edits of the last session were not saved. Open the autosaved data?',
+            QtGui.QMessageBox.Yes|QtGui.QMessageBox.No)
+        if answer!=QtGui.QMessageBox.Yes:
+            return False
+        path=Path(self.backup_path)+'recovered.dat'
+        shutil.copy(self.autosave.path,path)
+        self.set_data_from(str(path))
+        return True
+
     def save_menu(self):
         name = QtGui.QFileDialog.getSaveFileName(self, 'Save File')
         self.save_data_to(name)
@@ -84,8 +123,8 @@ class Editor(QtGui.QMainWindow):
         @block_changes.setter
         def block_changes(self,val):
             self._block_changes=val
-        def make_backup(self):
-            self.parent.make_backup()
+        def do_edit(self,*edits,**kwargs):
+            return self.parent.do_edit(*edits,**kwargs)
 
         def save_tree_state(self,tree):
             #To restore tree state
@@ -158,14 +197,19 @@ class Editor(QtGui.QMainWindow):
             newdata=[unicode(view.data(c,0).toString()) for c in range(view.columnCount())]
             cur=self.current_ontology
             try:
-                cur.rem_edge(*olddata)
-                cur.add_edge(*newdata)
+                i,j,e=olddata
+                removals=[RemEdge(cur,i,j,e),RemEdge(cur,j,i,e)]
+                add=AddEdge(cur,*newdata)
+                #The new edge is added after the removals (e.g. when source
+                #and target are swapped and both directions existed)
+                if [r for r in removals if r.existed and r.edge==add.edge]:
+                    add.existed=False
+                self.do_edit(*(removals+[add]))
                 handled =1
             except Exception as e:
                 print e
             if handled:
                 self.make_search()
-                self.make_backup()
             return handled
 
         def set_current_ontology(self,*args):
@@ -183,7 +227,12 @@ class Editor(QtGui.QMainWindow):
             if not text:
                 return self.set_display()
             query=QueryHandler(self.current_ontology)
-            self.set_display(query.filter(text,field=field,rule=rule) )
+            try:
+                content=query.filter(text,field=field,rule=rule)
+            except re.error:
+                #Incomplete regular expression
+                return
+            self.set_display(content)
 
         def set_display(self,content=None):
             twidget=self.ui.onto_table
@@ -252,11 +301,12 @@ class Editor(QtGui.QMainWindow):
                 return
             if self.block_changes:
                 return 0
-            data.uid=unicode(self.ui.uid_edit.text())
-            data.atoms=unicode(self.ui.tags_edit.document().toPlainText()).replace(' ','').split(',')
+            uid=unicode(self.ui.uid_edit.text())
+            atoms=unicode(self.ui.tags_edit.document().toPlainText()).replace(' ','').split(',')
             text=unicode(self.ui.text_edit.document().toPlainText()).split('\n')
-            self.text_db.set(data.uid,'text',text)
-            self.make_backup()
+            #Successive keystrokes make a single step in the undo history
+            self.do_edit(SetAttr(data,'uid',uid),SetAttr(data,'atoms',atoms),
+                SetText(self.text_db,uid,'text',text),merge=True)
 
 
         def change_dataitem(self,view):
@@ -271,14 +321,16 @@ class Editor(QtGui.QMainWindow):
                     #i=data[2]
                     if not j in self.node_db:
                         self.node_db.add(Node(i))
-                    data[0].states[self.node_db[i]]=j.replace(' ','').split(',')
+                    self.do_edit(SetItem(data[0],'states',self.node_db[i],
+                        j.replace(' ','').split(',')))
                     #self.set_action(data[0])
                     handled=1
                 elif data[1]=='state':
                     i,j=content
                     if not i in self.node_db:
                         self.node_db.add(Node(i))
-                    data[0].states[self.node_db[i]]=j.replace(' ','').split(',')
+                    self.do_edit(SetItem(data[0],'states',self.node_db[i],
+                        j.replace(' ','').split(',')))
                     handled=1
                 elif data[1]=='relationship':
                     i,j=[x.replace(' ','').split(',') for x in content]
@@ -289,12 +341,12 @@ class Editor(QtGui.QMainWindow):
                     handled=1
                     idx=self.ui.relationship_table.selectedIndexes()[0].row()
                     if idx<len(data[0].relations):
-                        data[0].relations[idx]=Relation(i,j)
+                        self.do_edit(SetItem(data[0],'relations',idx,Relation(i,j)))
                     else:
-                        data[0].relations.append(Relation(i,j))
+                        self.do_edit(InsertItem(data[0],'relations',
+                            len(data[0].relations),Relation(i,j)))
             if handled:
                 self.timeline=[self.seqview.frame_by_frame(seq) for seq in self.sequences]
-                self.make_backup()
             return handled
 
         def set_focused_object(self,obj):
@@ -502,19 +554,18 @@ class Editor(QtGui.QMainWindow):
             setup=Action(uid+'|setup|setup')
             setup_frame=Frame(uid+'|setup',actions=[setup])
             seq=Sequence(uid,frames=[setup_frame]  )
-            self.add_sequence(seq,
-                alone=True,position=self.sequences.index(obj)+1 )
-            self.make_backup()
+            self.do_edit(InsertItem(self.parent,'sequences',
+                self.sequences.index(obj)+1,seq))
+            self.renew_tree()
 
         def delete_sequence(self):
             indexes = self.ui.timeline_tree.selectedIndexes()
             view=self.ui.timeline_tree.itemFromIndex(indexes[0])
             obj=self.dico[view]
             del view
-            self.sequences.remove(obj)
+            self.do_edit(RemoveItem(self.parent,'sequences',obj))
             del obj
             self.renew_tree()
-            self.make_backup()
 
         def renew_tree(self):
             prevstate=self.save_tree_state(self.ui.timeline_tree)
@@ -545,17 +596,14 @@ class Editor(QtGui.QMainWindow):
             view=self.ui.timeline_tree.itemFromIndex(indexes[0])
             obj=self.dico[view]
             if isinstance(obj,Sequence):
-                fr=obj.new_frame()
-                fr.new_action()
-                self.add_frame(fr,obj)
-
+                seqs=[obj]
             else:
-                for seq in self.sequences:
-                    if obj in seq.frames:
-                        fr=seq.new_frame()
-                        fr.new_action()
-                        self.add_frame(fr,seq)
-            self.make_backup()
+                seqs=[seq for seq in self.sequences if obj in seq.frames]
+            for seq in seqs:
+                fr=Frame('{}|frame{}'.format(seq.uid,len(seq.frames) ) )
+                fr.new_action()
+                self.do_edit(AddFrame(seq,len(seq.frames),fr))
+                self.add_frame(fr,seq)
 
         def delete_frame(self):
             indexes = self.ui.timeline_tree.selectedIndexes()
@@ -563,10 +611,9 @@ class Editor(QtGui.QMainWindow):
             obj=self.dico[view]
             view.parent().removeChild(view)
             del view
-            for seq in self.sequences:
-                seq.rem_frame(obj)
+            self.do_edit(*[RemoveFrame(seq,obj) for seq in self.sequences
+                if obj in seq.frames])
             del obj
-            self.make_backup()
 
         def add_action(self,action,frame,seq):
             self.set_frame(frame)
@@ -576,18 +623,19 @@ class Editor(QtGui.QMainWindow):
             for seq in self.sequences:
                 for fr in seq.frames:
                     if obj in fr.actions:
-                        act=fr.new_action()
+                        act=Action('{}|action{}'.format(fr.uid,len(fr.actions) ) )
+                        self.do_edit(InsertItem(fr,'actions',len(fr.actions),act))
                         self.add_action(act,fr,seq)
-            self.make_backup()
 
         def delete_action(self,view):
             obj=self.dico[view]
             for seq in self.sequences:
                 for fr in seq.frames:
-                    if fr.rem_action(obj):
+                    if obj in fr.actions:
+                        self.do_edit(RemoveItem(fr,'actions',obj))
                         self.set_frame(fr)
-                        self.set_action(fr.actions[0])
-            self.make_backup()
+                        if fr.actions:
+                            self.set_action(fr.actions[0])
 
 
         def set_timeline_widget(self,*args):
@@ -623,6 +671,25 @@ class Editor(QtGui.QMainWindow):
                 #tree.setItemDelegate(ItemWordWrap(tree))
                 #tree.setWordWrap(True)
 
+        def refresh(self,objects):
+            """Update the views of sequences, frames and actions that were
+            modified in place."""
+            uids=set(obj.uid.split('|')[0] for obj in objects)
+            for idx,seq in enumerate(self.sequences):
+                if seq.uid in uids:
+                    self.timeline[idx]=self.seqview.frame_by_frame(seq)
+            sel=self.ui.timeline_tree.selectedItems()
+            if sel:
+                shown=self.dico[sel[0]].uid.split('|')[0]
+            else:
+                shown=self.sequences[0].uid
+            if shown in uids:
+                self.set_frame()
+            if self._focused in objects:
+                self.block_changes=1
+                self.set_focused_object(self._focused)
+                self.block_changes=0
+
         def set_data(self,sequences):
             self.text_db=self.parent.text_db
             self.atom_db=self.parent.atom_db
@@ -663,7 +730,18 @@ class Editor(QtGui.QMainWindow):
 
     def set_data_from(self,filename,log=1):
         self.iohandler=parser=IOHandler()
-        sequences=parser.parse(filename)
+        parser.shared_db=self.shared_db
+        #Recover edits journaled since the file was last saved
+        if self.journal:
+            self.journal.close()
+        self.journal=Journal(filename,self.JOURNAL_SIZE)
+        base=self.journal.base()
+        if base==self.journal.compact_path:
+            sequences=parser.parse_binary(base)
+        else:
+            sequences=parser.load(filename,cache=self.parse_cache)
+        if base:
+            self.journal.replay(parser,sequences)
 
         self.text_db=parser.text_db
         self.atom_db=parser.atom_db
@@ -683,51 +761,112 @@ class Editor(QtGui.QMainWindow):
             f.write(filename)
             f.close()
             print 'Setting data from',filename
-        self.undo_stack.append(filename)
+            self.watch_files()
+        self.history.clear()
+        self.journal.open(parser,self.sequences,self.history,resume=bool(base))
+
+    def watch_files(self):
+        """Watch the files read by the last parse (file and includes)."""
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+        if self.iohandler.includes:
+            self.watcher.addPaths(list(self.iohandler.includes))
+
+    def file_changed(self,path):
+        #Editors often save in several steps: wait for the file to settle
+        QtCore.QTimer.singleShot(200,lambda:self.apply_file_changes(unicode(path)))
+
+    def apply_file_changes(self,path):
+        """Patch the data with changes made to a file outside the editor,
+        re-parsing only the modified blocks when possible."""
+        import os
+        if not os.path.exists(path) or not Path(path).norm() in self.iohandler.includes:
+            return
+        if not path in self.watcher.files():
+            #The file was replaced rather than rewritten
+            self.watcher.addPath(path)
+        if self.saved_mtime.get(path)==os.path.getmtime(path):
+            return
+        updated=self.iohandler.reparse(self.sequences)
+        if updated is None:
+            self.set_data_from(list(self.iohandler.includes)[0],log=0)
+            self.watch_files()
+        elif updated:
+            #Edits recorded before may no longer apply to the new values
+            self.history.clear()
+            #The journal no longer applies to the source: keep the unsaved
+            #edits by compacting the data (with the changes) now
+            self.journal.checkpoint()
+            self.timeline_editor.refresh(updated)
 
     def save_data_to(self,filename,log=1):
+        import os
         self.iohandler.export(filename,self.sequences)
+        self.autosave.discard()
 
         #Logging the last file to reopen
         if log:
+            #Saved edits need not be replayed
+            if self.journal:
+                self.journal.close(remove=True)
+            self.journal=Journal(filename,self.JOURNAL_SIZE)
+            self.journal.open(self.iohandler,self.sequences,self.history)
+            #Our own writes should not trigger a reload
+            self.saved_mtime[unicode(filename)]=os.path.getmtime(filename)
             f=open(Path(self.log_path)+'.last','w')
             f.write(filename)
             f.close()
 
-    def make_backup(self):
-        #print debug_caller_name(3)
-        #import time
-        current=Path(self.backup_path)+'{}.bk'.format(self.SAVES) #time.asctime()
-        self.block_changes=True
-        #print "Making backup",current
-        self.save_data_to(current,log=0)
-        self.SAVES+=1
-
-        self.undo_stack.append(current)
-        self.redo_stack[:]=[]
-        if len(self.undo_stack)>self.MAXSAVES:
-            self.undo_stack.pop(0)
-            self.SAVES=0
-        self.block_changes=False
+    def do_edit(self,*edits,**kwargs):
+        """Apply edits to the data as one step of the undo history."""
+        edits=self.history.do(*edits,**kwargs)
+        if edits:
+            self.autosave.touch()
+            self.commit_databases()
+        return edits
+
+    def commit_databases(self):
+        """Make edits of shared ontologies visible to other editors."""
+        for db in (self.atom_db,self.node_db):
+            if hasattr(db,'commit'):
+                db.commit()
+
+    def show_edits(self,edits):
+        """Update the views after edits were undone or redone."""
+        if [e for e in edits if isinstance(e,(AddEdge,RemEdge))]:
+            self.db_editor.make_search()
+        objects=[e.obj for e in edits if isinstance(e,(SetAttr,SetItem,InsertItem,RemoveItem))]
+        if [e for e in edits if isinstance(e,(InsertItem,RemoveItem))
+                or isinstance(e,SetAttr) and e.attr=='uid']:
+            #Tree structure or labels changed
+            self.timeline_editor.timeline=[self.timeline_editor.seqview.frame_by_frame(seq)
+                for seq in self.sequences]
+            self.timeline_editor.renew_tree()
+        elif objects:
+            self.timeline_editor.refresh(objects)
+        elif edits:
+            self.timeline_editor.set_frame()
 
     def undo(self):
-        if len(self.undo_stack)<2:
-            return
-        last=self.undo_stack.pop(-1)
-        #print 'UNDO:',last,self.undo_stack
-        #self.block_changes=True
-        self.set_data_from(self.undo_stack.pop(-1),log=0)
-        self.redo_stack.append(last)
-        #self.block_changes=False
+        edits=self.history.undo()
+        if edits:
+            self.autosave.touch()
+            self.commit_databases()
+            self.show_edits(edits)
 
     def redo(self):
-        if len(self.redo_stack)<1:
-            return
-        #self.block_changes=True
-        last=self.redo_stack.pop(-1)
-        #print 'REDO:',last
-        self.set_data_from(last,log=0)
-        #self.block_changes=False
+        edits=self.history.redo()
+        if edits:
+            self.autosave.touch()
+            self.commit_databases()
+            self.show_edits(edits)
+
+    def closeEvent(self,event):
+        self.autosave_timer.stop()
+        self.autosave.close()
+        if self.journal:
+            self.journal.close()
+        QtGui.QMainWindow.closeEvent(self,event)
 
 
 
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 from ontology import *
 from classes import *
-from copy import deepcopy
 
 
 def debug_caller_name(skip=2):
@@ -63,6 +62,8 @@ class Path(str):
         """Make directories in path that don't exist"""
         import os
         cur=Path('./')
+        if os.path.isabs(self):
+            cur=Path(os.sep)
         for intdir in self.split():
             cur+=Path(intdir)
             if not os.path.isdir(cur):
@@ -105,6 +106,17 @@ class TextDatabase(object):
     def __contains__(self,uid):
         return uid in self.db
 
+    def update(self,other):
+        """Apply entries of other after ours: texts are replaced,
+        other types (e.g. comments) are appended."""
+        for uid,entry in other.db.iteritems():
+            self.add_id(uid)
+            for typ,val in entry.iteritems():
+                if typ=='text':
+                    self.set(uid,typ,list(val))
+                else:
+                    self.add(uid,typ,list(val))
+
 
 class SequenceViewer(object):
     '''Converter of Sequence into list of Databases (one per Frame) compiling
@@ -122,6 +134,7 @@ class SequenceViewer(object):
         (NB: simple inference = no black magic such as restoring a previous tag
         when removing a tag that had replaced it)"""
         graphs=[]
+        excl=self.atom_query.exclusions()
         for frame in sequence.frames:
             if graphs:
                 graph=graphs[-1].copy()
@@ -147,11 +160,8 @@ class SequenceViewer(object):
                                 graph.node[i.uid].append(j)
 
                             #Apply inference rules
-                            for other in tuple(graph.node[i.uid]):
-                                if other ==j:
-                                    continue
-                                if 'exclude' in self.atom_query.get_relations(j,other):
-                                    graph.node[i.uid].remove(other)
+                            for other in excl.excluded(j,graph.node[i.uid]):
+                                graph.node[i.uid].remove(other)
 
                 #RELATIONS
                 for r in action.relations:
@@ -165,48 +175,410 @@ class SequenceViewer(object):
                             graph.add_edge(src,tgt,atom)
 
                             #Apply inference rules
-                            for other in tuple(graph.edge[src][tgt]):
-                                if other==atom:
-                                    continue
-                                if 'exclude' in self.atom_query.get_relations(atom,other):
-                                    graph.edge[src][tgt].remove(other)
+                            for other in excl.excluded(atom,graph.edge[src][tgt]):
+                                graph.rem_edge(src,tgt,other,reciprocal=False)
         #return
         return graphs
 
+class BlockLexer(object):
+    """Single-pass lexer for the lines of a <...> block.
+
+    The first line is a header 'type: uid @ancestor1, ancestor2'.
+    Other lines are 'key: value', where key may carry a modifier '+' (extend)
+    or '-' (remove), and value is a list of comma-separated items. If the value
+    contains 'name:(a,b)' items, it is read as a dict of lists instead.
+    Commas inside parentheses do not separate items.
+    Spaces are ignored, except in the values of free text keys (text, note)
+    which are kept as raw strings, split on commas (except those followed
+    by the end of a parenthesized group), whatever parentheses they hold.
+    Each value is split by a single call to a compiled pattern."""
+
+    free_text=('text','note')
+    #Separator of free text items
+    text_sep=re.compile(',(?![\s\w,-_]*\))')
+    #Item of a list: run of characters and parenthesized groups up to a comma
+    list_item=re.compile('(?:\([^()]*\)|[^,()])+')
+    #Item of a dict: name or (names) followed by ':' and value or (values)
+    dict_item=re.compile('(?:\(([^()]*)\)|([^(),:]*)):(?:\(([^()]*)\)|([^(),:]*))')
+
+    def header(self,line):
+        """Return type, uid and list of ancestors from header line."""
+        typ,sep,uids=line.replace(' ','').partition(':')
+        uid,sep,inherit=uids.partition('@')
+        return typ,uid,[a for a in inherit.split(',') if a]
+
+    def line(self,line):
+        """Return (modifier, key, value) from a value line, or None if the
+        line has no value. Value is a list, or an OrderedDict of lists."""
+        key,sep,val=line.partition(':')
+        key=key.replace(' ','')
+        if not key:
+            return None
+        mod=''
+        if key[0] in '+-':
+            mod,key=key[0],key[1:]
+        if key in self.free_text:
+            val=[x.strip() for x in self.text_sep.split(val) if x.strip()]
+        else:
+            val=val.replace(' ','')
+            if not val:
+                return None
+            if ':' in val:
+                clean=OrderedDict()
+                for n1,n2,v1,v2 in self.dict_item.findall(val):
+                    name=n1 or n2
+                    if name in clean:
+                        clean[name]+=(v1 or v2).split(',')
+                    else:
+                        clean[name]=(v1 or v2).split(',')
+                val=clean
+            elif '(' in val:
+                val=self.list_item.findall(val)
+            else:
+                val=val.split(',')
+        if not val:
+            return None
+        return mod,key,val
+
+
+class BlockContent(dict):
+    """Contents of a <...> block, from key to list or OrderedDict of lists.
+
+    Values inherited from other blocks are shared rather than copied.
+    A shared value is only copied when it is first changed through
+    mutable, so inheriting costs one dict update until a key is modified.
+    Values must therefore never be changed in place by other means."""
+
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.owned=set(self)
+
+    def __setitem__(self,key,val):
+        dict.__setitem__(self,key,val)
+        self.owned.add(key)
+
+    def __reduce__(self):
+        return (self.__class__,(dict(self),),{'owned':self.owned})
+
+    def inherit(self,other):
+        """Share all values of other (overriding current ones)."""
+        self.update(other)
+        self.owned.difference_update(other)
+
+    def mutable(self,key,default):
+        """Return value of key, copied first if it is shared.
+        If key is absent, set it to default."""
+        if key in self.owned:
+            return self[key]
+        if key in self:
+            val=self[key]
+            if isinstance(val,dict):
+                val=OrderedDict((i,list(j)) for i,j in val.iteritems())
+            else:
+                val=list(val)
+        else:
+            val=default
+        self[key]=val
+        return val
+
+
+class ParseCache(object):
+    """On-disk cache of the results of IOHandler.parse.
+
+    Each entry stores the sequences, Databases and TextDatabase obtained from
+    a file, along with the content hash of every file read to produce them
+    (the file itself and all its includes, see IOHandler.includes). An entry
+    is only used if none of these files has changed since, and if it was
+    stored in the current format (to be increased whenever the classes
+    of the stored objects change)."""
+
+    format=11
+
+    def __init__(self,path):
+        self.path=Path(path)
+        self.path.mkdir()
+
+    @staticmethod
+    def file_hash(filename):
+        import hashlib
+        h=hashlib.sha1()
+        fin=open(filename,'rb')
+        for chunk in iter(lambda: fin.read(1<<20),''):
+            h.update(chunk)
+        fin.close()
+        return h.hexdigest()
+
+    def digest(self,sources):
+        """Combined hash of the contents of all source files."""
+        import hashlib
+        h=hashlib.sha1('{}\0'.format(self.format))
+        for src in sources:
+            h.update('{}\0{}\0'.format(src,self.file_hash(src)))
+        return h.hexdigest()
+
+    def entry(self,filename):
+        import hashlib,os
+        name=hashlib.sha1(os.path.abspath(filename)).hexdigest()
+        return self.path+'{}.cache'.format(name)
+
+    def load(self,filename):
+        """Return cached data for filename, or None if absent or outdated."""
+        import cPickle as pickle,os
+        entry=self.entry(filename)
+        if not os.path.isfile(entry):
+            return None
+        fin=open(entry,'rb')
+        try:
+            sources,digest=pickle.load(fin)
+            try:
+                if self.digest(sources)!=digest:
+                    return None
+            except (IOError,OSError):
+                #Some source file has disappeared
+                return None
+            #Unpickling allocates many objects at once: pause cyclic gc
+            import gc
+            enabled=gc.isenabled()
+            gc.disable()
+            try:
+                return pickle.load(fin)
+            finally:
+                if enabled:
+                    gc.enable()
+        except Exception as e:
+            print 'ParseCache: could not read {}: {}'.format(entry,e)
+            return None
+        finally:
+            fin.close()
+
+    def store(self,filename,data):
+        """Store data (dict) for filename, keyed by its current sources."""
+        import cPickle as pickle,os
+        entry=self.entry(filename)
+        sources=list(data['includes'])
+        fout=open(entry+'.tmp','wb')
+        pickle.dump((sources,self.digest(sources)),fout,pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data,fout,pickle.HIGHEST_PROTOCOL)
+        fout.close()
+        if os.path.exists(entry):
+            os.remove(entry)
+        os.rename(entry+'.tmp',entry)
+
+
+class BlockIndex(object):
+    """Sidecar index of a data file (stored next to it as file.idx, in JSON).
+
+    It records the byte span of every block in the file and its includes,
+    and for each sequence, its own blocks and those it depends on: all
+    ontology blocks, and the blocks it inherits from (transitively).
+    IOHandler.load_sequence uses it to parse one sequence without reading
+    the rest. The index is rebuilt if the size or modification time of
+    any of the files has changed."""
+
+    def __init__(self,filename):
+        self.filename=Path(filename).norm()
+        self.path=str(self.filename)+'.idx'
+        self.data=None
+
+    @staticmethod
+    def stat(path):
+        import os
+        st=os.stat(path)
+        return [path,st.st_size,st.st_mtime]
+
+    def valid(self,data):
+        try:
+            return all(self.stat(f[0])==f for f in data['files'])
+        except (IOError,OSError):
+            return False
+
+    def get(self):
+        """Return the index data, reading or rebuilding it as needed."""
+        import json,os
+        if self.data is not None and self.valid(self.data):
+            return self.data
+        data=None
+        if os.path.isfile(self.path):
+            try:
+                fin=open(self.path,'r')
+                #Uids and paths as utf-8 encoded str, as given by the parser
+                data=Journal.plain(json.load(fin))
+                fin.close()
+            except ValueError:
+                data=None
+        if data is None or not self.valid(data):
+            data=self.build()
+            self.store(data)
+        self.data=data
+        return data
+
+    def store(self,data):
+        import json,os
+        fout=open(self.path+'.tmp','w')
+        json.dump(data,fout)
+        fout.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path+'.tmp',self.path)
+
+    def build(self):
+        """Scan the file and its includes (block headers only)."""
+        handler=IOHandler()
+        files,blocks,deps,last=[],[],[],{}
+        ontology,sequences=[],[]
+
+        def scan(filename,stack):
+            path=Path(filename).norm()
+            files.append(path)
+            stack.append(path)
+            current=[]
+            seq=None
+            for start,end,obj_txt in handler.iter_spans(filename):
+                typ,uid,ancestors=handler.lexer.header(obj_txt.split('$')[0])
+                before=list(current)
+                uid,ancids=handler.block_uid(typ,uid,ancestors,current)
+                i=len(blocks)
+                blocks.append([path,start,end,before])
+                #Blocks whose content this one starts from (see read_block)
+                dep=set([])
+                for a in ancids+[uid]:
+                    if a in last:
+                        dep.add(last[a])
+                        dep.update(deps[last[a]])
+                deps.append(dep)
+                last[uid]=i
+                if typ=='include':
+                    incl=Path(Path(filename).curdir()+ uid)
+                    if incl in stack:
+                        raise Exception('Cyclic include: {}'.format(
+                            ' -> '.join(stack[stack.index(incl):]+[incl])))
+                    if not incl in files:
+                        scan(incl,stack)
+                elif typ=='ontology':
+                    ontology.append(i)
+                elif typ=='sequence':
+                    seq=[uid,[i]]
+                    sequences.append(seq)
+                elif seq:
+                    seq[1].append(i)
+            stack.pop()
+
+        scan(self.filename,[])
+        for seq in sequences:
+            region=set(seq[1])
+            seq.append(sorted(set([]).union(*[deps[i] for i in region])-region))
+        return {'files':[self.stat(f) for f in files],'blocks':blocks,
+            'ontology':ontology,'sequences':sequences}
+
+    def sequences(self):
+        """Uids of all sequences, in file order."""
+        return [seq[0] for seq in self.get()['sequences']]
+
+    def iter_blocks(self,indices):
+        """Yield (index,current,text) for the given blocks, in file order,
+        where current holds the uids of the sequence, frame and action being
+        read just before the block."""
+        blocks=self.get()['blocks']
+        files={}
+        for i in sorted(indices):
+            path,start,end,current=blocks[i]
+            if not path in files:
+                files[path]=open(path,'rb')
+            fin=files[path]
+            fin.seek(start)
+            yield i,list(current),IOHandler.block_text(fin.read(end-start))
+        for fin in files.values():
+            fin.close()
+
+
+def parse_include(filename):
+    """Parse an included file on its own (in a worker process).
+    Returns the parsed sequences and databases, or a dict with only the
+    error raised if the file cannot be parsed on its own (e.g. because it
+    uses the blocks of the files including it)."""
+    handler=IOHandler()
+    handler.new_databases()
+    objects,contents={},{}
+    try:
+        sequences=handler.parse(filename,objects,contents)
+    except Exception as e:
+        return {'error':'{}: {}'.format(e.__class__.__name__,e)}
+    result=dict((attr,getattr(handler,attr)) for attr in IOHandler.cached)
+    result.update(sequences=sequences,objects=objects,contents=contents,
+        redefinable=handler.redefinable)
+    return result
+
+
 class IOHandler(object):
+    lexer=BlockLexer()
+    shared_db=None #Path of a SQLite file storing atom_db and node_db (see SQLiteDatabase)
+    cached=('atom_db','node_db','action_db','sequence_db','text_db','includes',
+        'blocks')
+
+    def databases(self):
+        """SQLiteDatabases holding the data."""
+        return [db for db in (getattr(self,attr,None) for attr in self.cached)
+            if isinstance(db,SQLiteDatabase)]
+
+    def reader(self):
+        """Copy of the handler for exporting its data from another thread:
+        its SQLiteDatabases are replaced by new ones, with connections and
+        caches of the calling thread, which closes them once done (see
+        close). These only see committed changes."""
+        from copy import copy
+        handler=copy(self)
+        for attr in self.cached:
+            db=getattr(self,attr,None)
+            if isinstance(db,SQLiteDatabase):
+                setattr(handler,attr,SQLiteDatabase(db.typ,db.path,db.cache_size,db.scope))
+        return handler
+
+    def close(self):
+        """Close the SQLiteDatabases holding the data, if any."""
+        for db in self.databases():
+            db.close()
 
     def export(self,filename,sequences):
-        """Export data to file"""
-        txt=''''''
+        """Export data to file, or to any writable stream (e.g. a pipe
+        or gzip file), writing each block as soon as it is formatted."""
+        if hasattr(filename,'write'):
+            fout=filename
+        else:
+            fout=open(filename,'w')
+        try:
+            for txt in self.iter_export(sequences):
+                fout.write(txt)
+        finally:
+            if not fout is filename:
+                fout.close()
+
+    def iter_export(self,sequences):
+        """Yield the text of each block of the export of sequences."""
         for seq in sequences:
             tmp='''<sequence: {}\n'''.format(seq.uid)
             if seq.uid in self.text_db:
                 tmp+='text: {}\n'.format(', '.join(self.text_db.get(seq.uid,'text') ))
             if seq.atoms:
                 tmp+='tags: {}\n'.format(', '.join(seq.atoms) )
-            tmp+='>\n\n'
+            yield tmp+'>\n\n'
 
-            txt+=tmp
             for fr in seq.frames:
                 if fr.uid.split('|')[-1]=='setup':
                     act=fr.actions[0]
-                    tmp=''
                     for n in act.states:
-                        tmp+='<node: {}\ntags:{}>\n\n'.format(n.uid,
+                        yield '<node: {}\ntags:{}>\n\n'.format(n.uid,
                             ', '.join(act.states[n]))
                     for i in act.relations:
-                        tmp+='<relation:({})\ntags:{}>\n\n'.format(
+                        yield '<relation:({})\ntags:{}>\n\n'.format(
                             ','.join(i.nodes),
                             ','.join(i.atoms ) )
-                    txt+=tmp
                     continue
                 tmp='''<frame: {}\n'''.format(fr.uid.split('|')[-1] )
                 if fr.uid in self.text_db:
                     tmp+='text: {}\n'.format(', '.join(self.text_db.get(fr.uid,'text')))
                 if fr.atoms:
                     tmp+='tags: {}\n'.format(', '.join(fr.atoms) )
-                tmp+='>\n\n'
-                txt+=tmp
+                yield tmp+'>\n\n'
                 for act in fr.actions:
                     tmp='''<action: {}\n'''.format(act.uid.split('|')[-1])
                     if act.uid in self.text_db:
@@ -228,184 +600,751 @@ class IOHandler(object):
                             ','.join([unicode(z) for z in i.nodes]),
                             ','.join( i.atoms ) )
                             for i in act.relations]   ))
-                    tmp+='>\n\n'
-                    txt+=tmp
+                    yield tmp+'>\n\n'
 
-        fout=open(filename,'w')
-        fout.write(txt)
-        fout.close()
+    binary_magic='RLB\x01'
+    binary_sections=('STRS','ONTO','TEXT','SEQS')
 
-    def parse(self,filename,objects=None,contents=None):
-        if objects is None:
-            objects={}
-        if contents is None:
-            contents={}
+    def export_binary(self,filename,sequences):
+        """Export data to file (or writable stream) in the binary format read
+        by parse_binary. It holds everything written by export, along with
+        the ontologies and all of text_db, as length-prefixed sections:
+            STRS: table of all strings (uids, atoms, texts)
+            ONTO, TEXT, SEQS: arrays of 32-bit integers, counts and
+                indices in the string table, for the Databases, text_db
+                and the sequences with their frames and actions."""
+        import struct,sys
+        from array import array
+        code=[c for c in 'IL' if array(c).itemsize==4][0]
+        strings,index=[],{}
+        def sid(x):
+            k=index.get(x)
+            if k is None:
+                k=index[x]=len(strings)
+                strings.append(x)
+            return k
+        def add(ints,lst):
+            ints.append(len(lst))
+            ints.extend([sid(x) for x in lst])
+        def pack(ints):
+            arr=array(code,ints)
+            if sys.byteorder=='big':
+                arr.byteswap()
+            return arr.tostring()
+
+        onto=[]
+        for db in (self.atom_db,self.node_db,self.action_db,self.sequence_db):
+            onto.append(len(db.nodes))
+            for n in db.nodes:
+                onto.append(sid(n))
+                add(onto,db.node[n])
+            onto.append(len(db.edges))
+            for edge in db.edges:
+                onto.extend([sid(x) for x in edge])
+
+        text=[len(self.text_db.db)]
+        for uid,entry in self.text_db.db.iteritems():
+            text+=[sid(uid),len(entry)]
+            for typ,val in entry.iteritems():
+                text.append(sid(typ))
+                add(text,val)
+
+        seqs=[len(sequences)]
+        for seq in sequences:
+            seqs.append(sid(seq.uid))
+            add(seqs,seq.atoms)
+            seqs.append(len(seq.frames))
+            for fr in seq.frames:
+                seqs.append(sid(fr.uid))
+                add(seqs,fr.atoms)
+                seqs.append(len(fr.actions))
+                for act in fr.actions:
+                    seqs.append(sid(act.uid))
+                    add(seqs,act.atoms)
+                    for dic in (act.roles,act.states):
+                        seqs.append(len(dic))
+                        for node,val in dic.iteritems():
+                            seqs.append(sid(node.uid))
+                            add(seqs,val)
+                    seqs.append(len(act.relations))
+                    for rel in act.relations:
+                        add(seqs,[getattr(z,'uid',z) for z in rel.nodes])
+                        add(seqs,rel.atoms)
+
+        kinds=array('B',[isinstance(x,unicode) for x in strings])
+        blob=[x.encode('utf-8') if isinstance(x,unicode) else x for x in strings]
+        sections=(pack([len(strings)]+[len(x) for x in blob])+kinds.tostring()+''.join(blob),
+            pack(onto),pack(text),pack(seqs))
+
+        if hasattr(filename,'write'):
+            fout=filename
+        else:
+            fout=open(filename,'wb')
+        try:
+            fout.write(self.binary_magic)
+            for tag,payload in zip(self.binary_sections,sections):
+                fout.write(tag+struct.pack('<I',len(payload)))
+                fout.write(payload)
+        finally:
+            if not fout is filename:
+                fout.close()
+
+    def parse_binary(self,filename):
+        """Import data from a file (or readable stream) written by
+        export_binary. Returns the sequences, as parse would for the
+        text export of the same data."""
+        import struct,sys
+        from array import array
+        code=[c for c in 'IL' if array(c).itemsize==4][0]
+        def unpack(payload):
+            arr=array(code)
+            arr.fromstring(payload)
+            if sys.byteorder=='big':
+                arr.byteswap()
+            return arr
+
+        if hasattr(filename,'read'):
+            fin=filename
+        else:
+            fin=open(filename,'rb')
+        try:
+            if fin.read(4)!=self.binary_magic:
+                raise Exception('{} is not a binary corpus file'.format(filename))
+            sections={}
+            while True:
+                head=fin.read(8)
+                if len(head)<8:
+                    break
+                sections[head[:4]]=fin.read(struct.unpack('<I',head[4:])[0])
+        finally:
+            if not fin is filename:
+                fin.close()
+
+        payload=sections['STRS']
+        nstr=unpack(payload[:4])[0]
+        lengths=unpack(payload[4:4*nstr+4])
+        kinds=payload[4*nstr+4:5*nstr+4]
+        S,pos=[],5*nstr+4
+        for length,kind in zip(lengths,kinds):
+            x=payload[pos:pos+length]
+            S.append(x.decode('utf-8') if kind!='\0' else x)
+            pos+=length
+
+        self.new_databases(filename)
+        nxt=iter(unpack(sections['ONTO'])).next
+        def strs():
+            return [S[nxt()] for k in xrange(nxt())]
+        for db in (self.atom_db,self.node_db,self.action_db,self.sequence_db):
+            db.add_nodes_from([(S[nxt()],strs()) for k in xrange(nxt())])
+            db.add_edges_from([(S[nxt()],S[nxt()],S[nxt()]) for k in xrange(nxt())])
+
+        nxt=iter(unpack(sections['TEXT'])).next
+        for k in xrange(nxt()):
+            uid=S[nxt()]
+            for t in xrange(nxt()):
+                typ=S[nxt()]
+                self.text_db.set(uid,typ,strs())
+
+        nxt=iter(unpack(sections['SEQS'])).next
+        sequences=[]
+        for k in xrange(nxt()):
+            uid,atoms=S[nxt()],strs()
+            frames=[]
+            for f in xrange(nxt()):
+                fuid,fatoms=S[nxt()],strs()
+                actions=[]
+                for a in xrange(nxt()):
+                    auid,aatoms=S[nxt()],strs()
+                    roles,states=[OrderedDict((self.parse_node(S[nxt()]),strs())
+                        for r in xrange(nxt())) for dic in range(2)]
+                    relations=[]
+                    for r in xrange(nxt()):
+                        nodes=strs()
+                        relations.append(Relation(nodes,strs()))
+                    act=Action(auid,aatoms,roles,states,relations)
+                    actions.append(act)
+                frames.append(Frame(fuid,fatoms,actions))
+            seq=Sequence(uid,atoms,frames)
+            sequences.append(seq)
+            for obj in [seq]+frames+[act for fr in frames for act in fr.actions]:
+                for a in obj.atoms:
+                    self.atom_db.add_instance(Atom(a),obj)
+            self.add_instances(seq)
+        return sequences
+
+    def parse(self,filename,objects=None,contents=None,processes=None):
         """Import data from file"""
-        from ontology import Database
-        fin=open(filename,'r')
-        self.atom_db=Database('atom')
-        self.node_db=Database('node')
+        sequences=list(self.iterparse(filename,objects,contents,processes))
+        for db in (self.atom_db,self.node_db):
+            if hasattr(db,'commit'):
+                db.commit()
+        return sequences
+
+    def load(self,filename,cache=None,processes=None):
+        """Import data from file like parse, but if cache (ParseCache) holds
+        a result for it and none of the files involved has changed,
+        return that instead."""
+        if cache is None:
+            return self.parse(filename,processes=processes)
+        data=cache.load(filename)
+        if data is not None and [attr for attr in self.cached if not attr in data]:
+            #Stored by an older version
+            data=None
+        if data is None:
+            sequences=self.parse(filename,processes=processes)
+            data=dict((attr,getattr(self,attr)) for attr in self.cached)
+            data['sequences']=sequences
+            cache.store(filename,data)
+        else:
+            for attr in self.cached:
+                setattr(self,attr,data[attr])
+        return data['sequences']
+
+    def iter_blocks(self,filename):
+        """Read file line by line and yield the text of each <...> block
+        as soon as it is closed (non-empty lines stripped and joined by '$')."""
+        for start,end,obj_txt in self.iter_spans(filename):
+            yield obj_txt
+
+    def iter_spans(self,filename):
+        """Like iter_blocks, but yield (start,end,text) where start and end
+        are the byte offsets of the opening < and just after the closing >.
+        The file is memory-mapped and searched for delimiters, so that only
+        the bytes of each block are copied; files that cannot be mapped
+        (e.g. empty) are read line by line instead."""
+        import mmap
+        fin=open(filename,'rb')
+        try:
+            buf=mmap.mmap(fin.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,EnvironmentError):
+            for span in self.scan_blocks(fin):
+                yield span
+            fin.close()
+            return
+        try:
+            find=buf.find
+            end=0
+            while True:
+                start=find('<',end)
+                if start<0:
+                    break
+                end=find('>',start)
+                if end<0:
+                    break
+                end+=1
+                yield start,end,self.block_text(buf[start:end])
+        finally:
+            buf.close()
+            fin.close()
+
+    @staticmethod
+    def block_digest(obj_txt):
+        """Hash of the text of a block, to detect its changes."""
+        import hashlib
+        return hashlib.md5(obj_txt).digest()
+
+    @staticmethod
+    def block_text(raw):
+        """Text of a block from its raw bytes, from < to > included,
+        as given by scan_blocks."""
+        lines=raw[1:-1].split('\n')
+        if len(lines)==1:
+            return lines[0]
+        first,last=lines[0].rstrip(),lines[-1].lstrip()
+        middle=[l.strip() for l in lines[1:-1]]
+        return first+'$'+''.join([l+'$' for l in middle if l])+last
+
+    @staticmethod
+    def scan_blocks(lines,pos=0):
+        """Tokenizer of iter_spans, for any iterable of lines starting
+        at byte offset pos."""
+        block=None
+        for raw in lines:
+            l=raw.strip()
+            if not l:
+                pos+=len(raw)
+                continue
+            l+='$'
+            n=len(l)
+            while l:
+                if block is None:
+                    start=l.find('<')
+                    if start<0:
+                        break
+                    block=[]
+                    #Offset of l[k] is pos+indent+n-len(l)+k
+                    begin=pos+len(raw)-len(raw.lstrip())+n-len(l)+start
+                    l=l[start+1:]
+                else:
+                    end=l.find('>')
+                    if end<0:
+                        block.append(l)
+                        break
+                    block.append(l[:end])
+                    yield begin,pos+len(raw)-len(raw.lstrip())+n-len(l)+end+1,''.join(block)
+                    block=None
+                    l=l[end+1:]
+            pos+=len(raw)
+
+    def new_databases(self,source=None):
+        """Start from empty Databases. With shared_db, atom_db and node_db
+        keep the shared ontology, and only the instances recorded by the
+        last parse of source (file name) are removed."""
+        from ontology import Database,SQLiteDatabase
+        if self.shared_db:
+            scope=str(Path(source).norm()) if isinstance(source,basestring) else ''
+            self.atom_db=SQLiteDatabase('atom',self.shared_db,scope=scope)
+            self.node_db=SQLiteDatabase('node',self.shared_db,scope=scope)
+            for db in (self.atom_db,self.node_db):
+                db.clear_instances()
+        else:
+            self.atom_db=Database('atom')
+            self.node_db=Database('node')
         self.action_db=Database('action')
         self.sequence_db=Database('sequence')
         self.text_db=TextDatabase()
+        self.includes=OrderedDict() #Statistics of each file read, by Path
+        self.include_errors=OrderedDict() #Errors of parse_include, by Path
+        self.include_stack=[] #Files being read
+        self.redefinable=set([]) #Uids of ontology and include blocks
+        self.blocks=[] #(path,type,uid,digest,start,end) of all blocks read, in order
 
-        text=''''''
-        for l in fin:
-            if not l.strip():
-                continue
-            text+=l.strip()+'$'
+    def iterparse(self,filename,objects=None,contents=None,processes=None):
+        """Import data from file, yielding each Sequence as soon as it is
+        complete (i.e. when the next sequence starts or the file ends).
+        Blocks are read line by line rather than from the whole file,
+        and Sequences come out in the same order as returned by parse.
+
+        Each file is only read once: including a file that was already
+        included has no effect, and cyclic includes raise an Exception.
+        Statistics on the files read are kept in self.includes.
+
+        If processes is given, the files included by this file are parsed
+        in advance by that many worker processes (see start_includes)."""
+        import os
+        if objects is None:
+            objects={}
+        if contents is None:
+            contents={}
+            self.new_databases(filename)
+        path=Path(filename).norm()
+        stats=self.includes[path]={'bytes':os.path.getsize(filename),
+            'blocks':0,'types':{},'sequences':0,'uses':1}
+        self.include_stack.append(path)
+        pool,pooled=None,{}
+        if processes:
+            pool,pooled=self.start_includes(filename,processes)
 
         current=[]
         cur_obj=[]
-        main=[]
-
-        obj_pattern='<(.*?)>'
-        for obj_txt in re.findall(obj_pattern,text):
-            lines=[l for l in obj_txt.split('$') if l]
-            lines = [l if 'text' in l else l.replace(' ','') for l in lines]
-            typ,sep,uids=lines[0].partition(':')
-            uid,sep,inherit=[x.strip() for x in uids.partition('@')]
-            ancestors=[a.strip() for a in inherit.split(',') if a.strip() ]
-
-            #AUTOMATIC APPENDING OF UID
-            idprefix=''
-            if typ=='action':
-                idprefix='{}|'.format(current[1])
-                uid=idprefix+uid
-                current=current[:2]+[uid]
-            elif typ=='frame':
-                idprefix='{}|'.format(current[0])
-                uid=idprefix+uid
-                current=current[:1]+[uid]
-            elif typ=='sequence':
-                uid=idprefix+uid
-                current=[uid]
+        pending=[] #Sequences waiting for those opened before them to complete
 
+        try:
+            for start,end,obj_txt in self.iter_spans(filename):
+                typ,uid,content=self.read_block(obj_txt,current,contents)
+                self.blocks.append((path,typ,uid,self.block_digest(obj_txt),start,end))
+                stats['blocks']+=1
+                stats['types'][typ]=stats['types'].get(typ,0)+1
 
-            content={}
+                #PARSING OBJECT
+                if typ=='include':
+                    self.redefinable.add(uid)
+                    incl=Path(Path(filename).curdir()+ uid)
+                    if incl in self.include_stack:
+                        cycle=self.include_stack[self.include_stack.index(incl):]
+                        raise Exception('Cyclic include: {}'.format(
+                            ' -> '.join(cycle+[incl])))
+                    if incl in self.includes:
+                        self.includes[incl]['uses']+=1
+                        continue
+                    seqs=None
+                    if incl in pooled:
+                        result=pooled.pop(incl).get()
+                        if 'error' in result:
+                            self.include_errors[incl]=result['error']
+                        seqs=self.merge_include(result,objects,contents)
+                    if seqs is None:
+                        seqs=self.iterparse(incl,objects,contents)
+                    for seq in seqs:
+                        pending.append(seq)
+                        while pending and not (cur_obj and pending[0] is cur_obj[0]):
+                            yield pending.pop(0)
+                    continue
 
-            #INHERITANCE
-            for ancestor in ancestors:
-                nbpipes=len(ancestor.split('|'))
-                ancid='|'.join(idprefix.split('|')[nbpipes:])+ancestor.strip()
-                prevcontent=contents[ancid]
-                content.update(deepcopy(prevcontent))
-            if uid in contents: #If the same uid was already used previously, overwrite
-                content.update(deepcopy(contents[uid]))
-                #print content
-
-            for l in lines[1:]:
-                key,sep,val=l.partition(':')
-                if val:
-                    clean=re.split(',(?![\s\w,-_]*\))',val)
-                    if ':' in val:
-                        listmode=False
-                        cleandict=OrderedDict()
-                        for s in clean:
-                            i,j = [x.replace('(','').replace(')','') for x in s.split(':')]
-                            j=j.split(',')
-                            if i in cleandict:
-                                cleandict[i]+=j
-                            else:
-                                cleandict[i]=j
-                        clean=cleandict
-                    else:
-                        listmode=True
-                    if key[0]=='+':
-                        key=key[1:]
-                        if listmode:
-                            content[key]+=clean
-                        else:
-                            for i in clean:
-                                content[key].setdefault(i,[])
-                                content[key][i]+=clean[i]
-
-                    elif key[0]=='-':
-                        key=key[1:]
-                        for i in clean:
-                            if listmode:
-                                if i in content[key]:
-                                    content[key].remove(i)
-                            else:
-                                content[key].setdefault(i,[])
-                                for j in clean[i]:
-                                    if j in content[key][i]:
-                                        content[key][i].remove(j)
-                                if not content[key][i]:
-                                    del content[key][i]
-                    else:
-                        content[key]=clean
-            contents[uid]={}
-            contents[uid].update(content)
-
-            #PARSING OBJECT
-            if typ=='include':
-                incl=Path(filename).curdir()+ uid
-                main+=self.parse(incl,objects,contents)
-                continue
-            elif typ=='ontology':
-                self.parse_ontology(uid,content)
-                continue
-            elif typ=='node':
-                obj=self.parse_node(uid,content)
-                objects[current[0]].setup.add_change(obj,content.get('tags',[]) )
+                obj=self.build_block(typ,uid,content,current,cur_obj,objects)
+                if typ=='sequence':
+                    stats['sequences']+=1
+                    pending.append(obj)
+                    while not pending[0] is obj:
+                        yield pending.pop(0)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-            elif typ=='relation':
-                obj=self.parse_relation(uid,content)
-                objects[current[0]].setup.add_relation(obj)
-                for a in obj.atoms:
-                    self.node_db.add_edge(obj.nodes[0],obj.nodes[1],a)
-            elif typ=='action':
-                obj=self.parse_action(uid,content)
-                if len(cur_obj)==2:
-                    cur_obj.append(obj)
-                else:
-                    cur_obj=cur_obj[:2]+[obj]
-                cur_obj[1].add_action(obj)
-
-                #Put all nodes that are never referenced before into setup action
-                for n in obj.nodes:
-                    objects[current[0]].setup.add_change(n,[])
-                for r in obj.relations:
-                    for nt in r.nodes:
-                        n=self.node_db.get(nt,Node(nt))
-                        objects[current[0]].setup.add_change(n,[])
-
-            elif typ=='frame':
-                obj=self.parse_frame(uid,content)
-                if len(cur_obj)==1:
-                    cur_obj.append(obj)
-                else:
-                    cur_obj=cur_obj[:1]+[obj]
-                cur_obj[0].add_frame(obj)
-            elif typ=='sequence':
-                obj=self.parse_sequence(uid,content)
-                cur_obj=[obj]
-                main.append(obj)
-
-            objects[uid]=obj
-            notes=content.pop('note',[])+content.pop('text',[])
-            if notes:
-                #print 'GETTING TEXT',uid,notes
-                n=notes.pop(0)
-                self.text_db.set(uid,'text',n.strip())
-                [self.text_db.add(uid,'comment',n.strip()) for n in notes]
-
-            if typ in ('sequence','frame','action'):
-                for a in obj.atoms:
-                    self.atom_db.add_instance(Atom(a),obj)
+        if cur_obj:
+            self.add_instances(cur_obj[0])
+        self.include_stack.pop()
+        for seq in pending:
+            yield seq
+
+    def build_block(self,typ,uid,content,current,cur_obj,objects):
+        """Create the object for a block read by read_block, and attach it to
+        the sequence and frame being built (cur_obj, updated in place).
+        Returns the object (None for ontology blocks)."""
+        if typ=='ontology':
+            self.parse_ontology(uid,content)
+            self.redefinable.add(uid)
+            return None
+        elif typ=='node':
+            obj=self.parse_node(uid,content)
+            objects[current[0]].setup.add_change(obj,content.get('tags',[]) )
+
+        elif typ=='relation':
+            obj=self.parse_relation(uid,content)
+            objects[current[0]].setup.add_relation(obj)
+            self.node_db.add_edges_from((obj.nodes[0],obj.nodes[1],a) for a in obj.atoms)
+        elif typ=='action':
+            obj=self.parse_action(uid,content)
+            cur_obj[2:]=[obj]
+            cur_obj[1].add_action(obj)
+
+            self.add_to_setup(objects[current[0]],obj)
+
+        elif typ=='frame':
+            obj=self.parse_frame(uid,content)
+            cur_obj[1:]=[obj]
+            cur_obj[0].add_frame(obj)
+        elif typ=='sequence':
+            obj=self.parse_sequence(uid,content)
+            if cur_obj:
+                self.add_instances(cur_obj[0])
+            cur_obj[:]=[obj]
+
+        objects[uid]=obj
+        self.set_notes(uid,content)
+
+        if typ in ('sequence','frame','action'):
+            for a in obj.atoms:
+                self.atom_db.add_instance(Atom(a),obj)
+        return obj
+
+    def add_to_setup(self,seq,act):
+        """Put all nodes of an action that are never referenced before
+        into the setup action of its sequence."""
+        for n in act.nodes:
+            seq.setup.add_change(n,[])
+        for r in act.relations:
+            for nt in r.nodes:
+                n=self.node_db.get(nt,Node(nt))
+                seq.setup.add_change(n,[])
+
+    def set_notes(self,uid,content):
+        """Store text and notes of a block in text_db: the first one as
+        text, the others as comments."""
+        notes=content.pop('note',[])+content.pop('text',[])
+        if notes:
+            #print 'GETTING TEXT',uid,notes
+            n=notes.pop(0)
+            self.text_db.set(uid,'text',n.strip())
+            [self.text_db.add(uid,'comment',n.strip()) for n in notes]
+
+    def load_sequence(self,filename,uid,index=None):
+        """Import a single sequence from file, parsing only its own blocks,
+        the ontologies and the blocks it inherits from, as listed in
+        index (BlockIndex of the file, built if not given)."""
+        if index is None:
+            index=BlockIndex(filename)
+        data=index.get()
+        for seq in data['sequences']:
+            if seq[0]==uid:
+                break
+        else:
+            raise Exception('No sequence {} in {}'.format(uid,filename))
+        self.new_databases(filename)
+        objects,contents={},{}
+        region=set(seq[1])
+        cur_obj=[]
+        for i,current,obj_txt in index.iter_blocks(region.union(seq[2],data['ontology'])):
+            typ,buid,content=self.read_block(obj_txt,current,contents)
+            if i in region or typ=='ontology':
+                self.build_block(typ,buid,content,current,cur_obj,objects)
+        if cur_obj:
+            self.add_instances(cur_obj[0])
+        return cur_obj[0]
+
+    def reparse(self,sequences):
+        """Read again the files of the last parse, and apply their changes
+        in place to sequences (as returned by parse) and the databases.
+        Only the sequence, frame and action blocks whose text has changed,
+        and the blocks that inherit from them, are parsed again.
 
-        for seq in main:
+        Atoms that are no longer used remain in atom_db.
+
+        Returns the list of updated objects, or None if the changes require
+        a full parse: blocks added, removed or renamed, or changes in
+        ontology, include, node or relation blocks."""
+        import os
+        spans=dict((path,self.iter_spans(path)) for path in self.includes)
+        currents=dict((path,[]) for path in spans)
+        blocks,befores,deps,last=[],[],[],{}
+        changed=set([])
+        for i,(path,typ,uid,old,ostart,oend) in enumerate(self.blocks):
+            span=next(spans[path],None)
+            if span is None:
+                return None
+            start,end,obj_txt=span
+            ntyp,nuid,ancestors=self.lexer.header(obj_txt.split('$')[0])
+            befores.append(list(currents[path]))
+            nuid,ancids=self.block_uid(ntyp,nuid,ancestors,currents[path])
+            if (ntyp,nuid)!=(typ,uid):
+                return None
+            digest=self.block_digest(obj_txt)
+            blocks.append((path,typ,uid,digest,start,end))
+            #Blocks whose content this one starts from (see read_block)
+            dep=set(last[a] for a in ancids+[uid] if a in last)
+            deps.append(dep)
+            last[uid]=i
+            if digest!=old or dep & changed:
+                changed.add(i)
+        if [path for path in spans if next(spans[path],None) is not None]:
+            return None
+        if not changed:
+            return []
+        if [i for i in changed if not blocks[i][1] in ('sequence','frame','action')]:
+            return None
+
+        objs={}
+        for seq in sequences:
+            objs.setdefault(seq.uid,[]).append(seq)
             for fr in seq.frames:
+                objs.setdefault(fr.uid,[]).append(fr)
                 for act in fr.actions:
-                    for node in act.states:
-                        for a in act.states[node]:
-                            self.atom_db.add_instance(Atom(a),(act,node) )
-                    for rel in act.relations:
-                        for a in rel.atoms:
-                            self.atom_db.add_instance(Atom(a),(act,rel.nodes ) )
-        #self.objects=objects
-        return main
+                    objs.setdefault(act.uid,[]).append(act)
+        if [i for i in changed if len(objs.get(blocks[i][2],()))!=1]:
+            return None
+
+        #Read changed blocks along with those they inherit from
+        needed=set(changed)
+        stack=list(changed)
+        while stack:
+            for d in deps[stack.pop()]:
+                if not d in needed:
+                    needed.add(d)
+                    stack.append(d)
+        contents,updates,files={},[],{}
+        for i in sorted(needed):
+            path,start,end=blocks[i][0],blocks[i][4],blocks[i][5]
+            if not path in files:
+                files[path]=open(path,'rb')
+            files[path].seek(start)
+            current=befores[i]
+            typ,uid,content=self.read_block(self.block_text(files[path].read(end-start)),
+                current,contents)
+            if i in changed:
+                updates.append((typ,uid,content,current))
+        for fin in files.values():
+            fin.close()
+
+        updated=[]
+        for typ,uid,content,current in updates:
+            obj=objs[uid][0]
+            for a in obj.atoms:
+                self.atom_db.rem_instance(Atom(a),obj)
+            if typ=='action':
+                for atom,loc in self.action_instances(obj):
+                    self.atom_db.rem_instance(atom,loc)
+                new=self.parse_action(uid,content)
+                obj.atoms,obj.roles,obj.states,obj.relations=(new.atoms,
+                    new.roles,new.states,new.relations)
+                self.add_to_setup(objs[current[0]][0],obj)
+                for atom,loc in self.action_instances(obj):
+                    self.atom_db.add_instance(atom,loc)
+            else:
+                obj.atoms=list(content.pop('tags',()))
+            self.text_db.db.pop(uid,None)
+            self.set_notes(uid,content)
+            for a in obj.atoms:
+                self.atom_db.add_instance(Atom(a),obj)
+            updated.append(obj)
+        self.blocks=blocks
+        for path in self.includes:
+            self.includes[path]['bytes']=os.path.getsize(path)
+        return updated
+
+    def start_includes(self,filename,processes):
+        """Submit the files included by filename to a pool of processes,
+        each parsed on its own by parse_include.
+        Returns the pool (None if there is nothing to include), to be
+        terminated once done, and a dict of AsyncResults by included Path."""
+        import multiprocessing
+        paths=[]
+        for obj_txt in self.iter_blocks(filename):
+            typ,uid,ancestors=self.lexer.header(obj_txt.split('$')[0])
+            incl=Path(Path(filename).curdir()+ uid)
+            if typ=='include' and not incl in paths and not incl in self.includes:
+                paths.append(incl)
+        pooled={}
+        if not paths:
+            return None,pooled
+        pool=multiprocessing.Pool(processes)
+        for incl in paths:
+            pooled[incl]=pool.apply_async(parse_include,(incl,))
+        pool.close()
+        return pool,pooled
+
+    def include_report(self):
+        """Describe what each file read contributed to the last parse."""
+        lines=[]
+        for path,stats in self.includes.iteritems():
+            lines.append('{}: {} bytes, {} blocks ({}), {} sequences, included {} times'.format(
+                path,stats['bytes'],stats['blocks'],
+                ', '.join('{} {}'.format(n,typ) for typ,n in sorted(stats['types'].items())),
+                stats['sequences'],stats['uses']))
+            if path in self.include_errors:
+                lines.append('  could not be parsed on its own, read serially ({})'.format(
+                    self.include_errors[path]))
+        return '\n'.join(lines)
+
+    def merge_include(self,result,objects,contents):
+        """Merge the result of parse_include into the current parse, in the
+        same way as parsing the included file at this point would have.
+        Returns the included sequences, or None if the file could not be
+        parsed independently (parse_include failed, e.g. as it uses blocks
+        of the including files, or it redefines their uids) and must be
+        parsed serially.
+        Ontology and include blocks may be redefined, since the contents
+        they inherit from previous definitions have no further effect."""
+        if 'error' in result:
+            return None
+        redefinable=result['redefinable'] & self.redefinable
+        if [uid for uid in result['contents'] if uid in contents
+                and not uid in redefinable]:
+            return None
+        #Files already read here would not be read again: this is only
+        #equivalent if they contain nothing but ontologies and includes
+        for path,stats in result['includes'].iteritems():
+            if path in self.includes and set(stats['types'])-set(['ontology','include']):
+                return None
+        #Nodes already known here replace those created by the included file
+        node_db=result['node_db']
+        remap=dict((id(node_db.object[uid]),self.node_db.object[uid])
+            for uid in node_db.object if uid in self.node_db.object)
+        def rmp(x):
+            return remap.get(id(x),x)
+        for seq in result['sequences']:
+            for fr in seq.frames:
+                for act in fr.actions:
+                    act.roles=OrderedDict((rmp(i),j) for i,j in act.roles.iteritems())
+                    act.states=OrderedDict((rmp(i),j) for i,j in act.states.iteritems())
+        for db in (result['atom_db'],node_db):
+            for uid,locs in db.instances.items():
+                db.instances[uid]=set(tuple(rmp(x) for x in loc)
+                    if isinstance(loc,tuple) else loc for loc in locs)
+        for attr in ('atom_db','node_db','action_db','sequence_db','text_db'):
+            getattr(self,attr).update(result[attr])
+        self.blocks+=[b for b in result['blocks'] if not b[0] in self.includes]
+        for path,stats in result['includes'].iteritems():
+            if path in self.includes:
+                self.includes[path]['uses']+=stats['uses']
+            else:
+                self.includes[path]=stats
+        self.redefinable.update(result['redefinable'])
+        objects.update(result['objects'])
+        contents.update(result['contents'])
+        return result['sequences']
+
+    def read_block(self,obj_txt,current,contents):
+        """Read the text of a block into its type, uid and content, resolving
+        inheritance from previous blocks. Updates current (uids of the
+        sequence, frame and action being read) and contents in place."""
+        lexer=self.lexer
+        lines=[l for l in obj_txt.split('$') if l]
+        typ,uid,ancestors=lexer.header(lines[0])
+
+        uid,ancids=self.block_uid(typ,uid,ancestors,current)
+        content=BlockContent()
+
+        #INHERITANCE
+        for ancid in ancids:
+            content.inherit(contents[ancid])
+        if uid in contents: #If the same uid was already used previously, overwrite
+            content.inherit(contents[uid])
+            #print content
+
+        for l in lines[1:]:
+            parsed=lexer.line(l)
+            if parsed is None:
+                continue
+            mod,key,clean=parsed
+            listmode=not isinstance(clean,dict)
+            if mod=='+':
+                if listmode:
+                    content.mutable(key,[]).extend(clean)
+                else:
+                    cur=content.mutable(key,OrderedDict())
+                    for i in clean:
+                        cur.setdefault(i,[])
+                        cur[i]+=clean[i]
+
+            elif mod=='-':
+                if not key in content:
+                    continue
+                cur=content.mutable(key,None)
+                for i in clean:
+                    if listmode:
+                        if i in cur:
+                            cur.remove(i)
+                    elif i in cur:
+                        for j in clean[i]:
+                            if j in cur[i]:
+                                cur[i].remove(j)
+                        if not cur[i]:
+                            del cur[i]
+            else:
+                content[key]=clean
+        contents[uid]=content
+        return typ,uid,dict(content)
+
+    def block_uid(self,typ,uid,ancestors,current):
+        """Full uids of a block and of its ancestors, given the uids of the
+        sequence, frame and action being read (current, updated in place)."""
+        #AUTOMATIC APPENDING OF UID
+        idprefix=''
+        if typ=='action':
+            idprefix='{}|'.format(current[1])
+            uid=idprefix+uid
+            current[2:]=[uid]
+        elif typ=='frame':
+            idprefix='{}|'.format(current[0])
+            uid=idprefix+uid
+            current[1:]=[uid]
+        elif typ=='sequence':
+            uid=idprefix+uid
+            current[:]=[uid]
+        ancids=[]
+        for ancestor in ancestors:
+            nbpipes=len(ancestor.split('|'))
+            ancids.append('|'.join(idprefix.split('|')[nbpipes:])+ancestor.strip())
+        return uid,ancids
+
+    def add_instances(self,seq):
+        """Record the atoms of all states and relations of a sequence
+        as instances in atom_db."""
+        for fr in seq.frames:
+            for act in fr.actions:
+                for atom,loc in self.action_instances(act):
+                    self.atom_db.add_instance(atom,loc)
+
+    def action_instances(self,act):
+        """Atoms of the states and relations of an action, with their
+        location as recorded in atom_db.instances."""
+        for node in act.states:
+            for a in act.states[node]:
+                yield Atom(a),(act,node)
+        for rel in act.relations:
+            for a in rel.atoms:
+                yield Atom(a),(act,rel.nodes)
 
     def parse_ontology(self,typ,content=None):
         if content is None:
@@ -418,14 +1357,15 @@ class IOHandler(object):
             ont=self.action_db
         elif typ=='sequence':
             ont=self.sequence_db
-        for s in content.get('states',[]):
-            states=content['states']
-            for elem in states:
-                ont.add_node(elem,states[elem])
-        for r in content.get('relations',[]):
-            obj=r.replace('(','').replace(')','').split(',')
-            for rel in content['relations'][r]:
-                ont.add_edge(obj[0],obj[1],rel)
+        states=content.get('states',{})
+        ont.add_nodes_from((elem,states[elem]) for elem in states)
+        relations=content.get('relations',{})
+        def edges():
+            for r in relations:
+                obj=r.replace('(','').replace(')','').split(',')
+                for rel in relations[r]:
+                    yield obj[0],obj[1],rel
+        ont.add_edges_from(edges())
 
     def parse_node(self,uid,content=None):
         if content is None:
@@ -451,14 +1391,15 @@ class IOHandler(object):
 
     def parse_action(self,uid,content):
         tags,states,relations,roles=content.pop('tags',()),content.pop('states', ()
-            ),content.pop('relations',()),content.pop('roles',{} )
+            ),content.pop('relations',()),OrderedDict(content.pop('roles',{} ))
         #print states
         #print relations
-        roles.update(OrderedDict([( j[0],[i]) for i, j in content.iteritems()]) )
+        roles.update(OrderedDict([( j[0],[i]) for i, j in content.iteritems()
+            if not i in self.lexer.free_text]) )
         act= Action(uid, atoms=tags,
-            states=OrderedDict([(self.parse_node(i),states[i]) for i in states]),
+            states=OrderedDict([(self.parse_node(i),list(states[i])) for i in states]),
             relations=[self.parse_relation(r,{'tags':relations[r]}) for r in relations],
-            roles=OrderedDict([(self.parse_node(i),roles[i]) for i in roles]) )
+            roles=OrderedDict([(self.parse_node(i),list(roles[i])) for i in roles]) )
         return act
 
     def parse_frame(self,uid,content):
@@ -471,3 +1412,799 @@ class IOHandler(object):
         setup_frame=Frame(uid+'|setup',actions=[setup])
         return Sequence(uid,atoms=tags,frames=[setup_frame])
 
+
+
+#========================================================================#
+# EDITING
+#========================================================================#
+
+class Edit(object):
+    """Reversible edit operation on the data.
+
+    Attributes:
+        obj: Object whose attribute attr is modified (or contains the
+            modified item), e.g. an Action and 'states'."""
+
+    obj=None
+    attr=None
+
+    def apply(self):
+        raise NotImplementedError
+
+    def revert(self):
+        raise NotImplementedError
+
+    @property
+    def changes(self):
+        """False if applying the edit would have no effect."""
+        return True
+
+    @property
+    def target(self):
+        """Key of the value replaced by the edit, for edits that may be merged
+        with the next edit of the same value (e.g. when typing), else None."""
+        return None
+
+
+class SetAttr(Edit):
+    """Replace the value of obj.attr."""
+
+    def __init__(self,obj,attr,new):
+        self.obj,self.attr=obj,attr
+        self.old,self.new=getattr(obj,attr),new
+
+    def apply(self):
+        setattr(self.obj,self.attr,self.new)
+
+    def revert(self):
+        setattr(self.obj,self.attr,self.old)
+
+    @property
+    def changes(self):
+        return self.old!=self.new
+
+    @property
+    def target(self):
+        return (id(self.obj),self.attr)
+
+
+class SetItem(Edit):
+    """Set (or add) item key in obj.attr, a dict or list."""
+
+    MISSING=object()
+
+    def __init__(self,obj,attr,key,new):
+        self.obj,self.attr,self.key,self.new=obj,attr,key,new
+        try:
+            self.old=getattr(obj,attr)[key]
+        except (KeyError,IndexError):
+            self.old=self.MISSING
+
+    def apply(self):
+        getattr(self.obj,self.attr)[self.key]=self.new
+
+    def revert(self):
+        container=getattr(self.obj,self.attr)
+        if self.old is self.MISSING:
+            del container[self.key]
+        else:
+            container[self.key]=self.old
+
+    @property
+    def changes(self):
+        return self.old is self.MISSING or self.old!=self.new
+
+    @property
+    def target(self):
+        return (id(self.obj),self.attr,id(self.key))
+
+
+class InsertItem(Edit):
+    """Insert item at position index in list obj.attr."""
+
+    def __init__(self,obj,attr,index,item):
+        self.obj,self.attr,self.index,self.item=obj,attr,index,item
+
+    def apply(self):
+        getattr(self.obj,self.attr).insert(self.index,self.item)
+
+    def revert(self):
+        del getattr(self.obj,self.attr)[self.index]
+
+
+class RemoveItem(Edit):
+    """Remove item from list obj.attr."""
+
+    def __init__(self,obj,attr,item):
+        self.obj,self.attr,self.item=obj,attr,item
+        self.index=getattr(obj,attr).index(item)
+
+    def apply(self):
+        del getattr(self.obj,self.attr)[self.index]
+
+    def revert(self):
+        getattr(self.obj,self.attr).insert(self.index,self.item)
+
+
+class AddFrame(InsertItem):
+    """Insert frame at position index in a Sequence, through
+    Sequence.add_frame so that its nodes are recorded."""
+
+    def __init__(self,seq,index,frame):
+        InsertItem.__init__(self,seq,'frames',index,frame)
+
+    def apply(self):
+        #Nodes that only the new frame records
+        self.created=[n for n in self.item.nodes if not n in self.obj.nodes]
+        self.obj.add_frame(self.item,self.index)
+
+    def revert(self):
+        self.obj.rem_frame(self.item)
+        for n in self.created:
+            self.obj.nodes.pop(n,None)
+
+
+class RemoveFrame(RemoveItem):
+    """Remove frame from a Sequence, through Sequence.rem_frame so that
+    it is no longer referenced by the nodes of the sequence."""
+
+    def __init__(self,seq,frame):
+        RemoveItem.__init__(self,seq,'frames',frame)
+
+    def apply(self):
+        nodes=self.obj.nodes
+        #Frames recorded for each node, restored in the same order
+        self.recorded=dict((n,list(nodes[n])) for n in self.item.nodes if n in nodes)
+        self.obj.rem_frame(self.item)
+
+    def revert(self):
+        nodes=self.obj.nodes
+        self.obj.add_frame(self.item,self.index)
+        for n in self.item.nodes:
+            if n in self.recorded:
+                nodes[n][:]=self.recorded[n]
+            else:
+                nodes.pop(n,None)
+
+
+class SetText(Edit):
+    """Replace the text of type typ for uid in a TextDatabase."""
+
+    def __init__(self,text_db,uid,typ,new):
+        self.text_db,self.uid,self.typ,self.new=text_db,uid,typ,new
+        self.existed=typ in text_db.db.get(uid,())
+        self.old=list(text_db.db[uid][typ]) if self.existed else []
+
+    def apply(self):
+        self.text_db.set(self.uid,self.typ,self.new)
+
+    def revert(self):
+        if self.existed:
+            self.text_db.set(self.uid,self.typ,self.old)
+            return
+        entry=self.text_db.db[self.uid]
+        del entry[self.typ]
+        if not entry:
+            del self.text_db.db[self.uid]
+
+    @property
+    def changes(self):
+        return self.old!=self.new
+
+    @property
+    def target(self):
+        return (id(self.text_db),self.uid,self.typ)
+
+
+class AddEdge(Edit):
+    """Add edge (i,j,e) to an Ontology. Whether it existed is checked again
+    when it is applied, after the previous edits of its step."""
+
+    def __init__(self,ontology,i,j,e):
+        self.obj,self.edge=ontology,(i,j,e)
+        self.existed=self.edge in ontology.edges
+
+    def apply(self):
+        self.existed=self.edge in self.obj.edges
+        self.obj.add_edge(*self.edge)
+
+    def revert(self):
+        if not self.existed:
+            self.obj.rem_edge(*self.edge,reciprocal=False)
+
+    @property
+    def changes(self):
+        return not self.existed
+
+
+class RemEdge(Edit):
+    """Remove edge (i,j,e) from an Ontology. Its position is recorded when
+    it is applied, after the previous edits of its step."""
+
+    def __init__(self,ontology,i,j,e):
+        self.obj,self.edge=ontology,(i,j,e)
+        self.existed=self.edge in ontology.edges
+
+    def apply(self):
+        edges=self.obj.edges
+        self.existed=self.edge in edges
+        if self.existed:
+            self.index=edges.index(self.edge)
+        self.obj.rem_edge(*self.edge,reciprocal=False)
+
+    def revert(self):
+        if self.existed:
+            self.obj.add_edge(*self.edge)
+            #Restore the position of the edge
+            self.obj.edges.insert(self.index,self.edge)
+
+    @property
+    def changes(self):
+        return self.existed
+
+
+class EditHistory(object):
+    """Undo and redo stacks of edits. Each step is a list of Edits,
+    applied in order and reverted in reverse order.
+
+    Attributes:
+        listeners (list): Callables f(edit,undo) called after each edit
+            is applied (undo=False) or reverted (undo=True).
+        version (int): Incremented before and after each step, so it is odd
+            while data is being modified. Other threads reading the data
+            can check that it is even and unchanged after they are done."""
+
+    def __init__(self,maxlen=None):
+        self.maxlen=maxlen
+        self.undo_stack=[]
+        self.redo_stack=[]
+        self.merging=False
+        self.listeners=[]
+        self.version=0
+
+    def run(self,edits,undo=False):
+        """Apply (or revert, in reverse order) edits and notify listeners."""
+        self.version+=1
+        try:
+            for e in (reversed(edits) if undo else edits):
+                if undo:
+                    e.revert()
+                else:
+                    e.apply()
+                for listener in self.listeners:
+                    listener(e,undo)
+        finally:
+            self.version+=1
+
+    def do(self,*edits,**kwargs):
+        """Apply edits as one step, and return them (an empty list if none
+        of them changes anything). With merge=True, they are merged into
+        the previous step if it was also merged and edits the same values."""
+        edits=[e for e in edits if e.changes]
+        if not edits:
+            return edits
+        self.run(edits)
+        self.redo_stack[:]=[]
+        merge=kwargs.get('merge',False)
+        if merge and self.merging and self.undo_stack:
+            last=self.undo_stack[-1]
+            targets=[(type(e),e.target) for e in edits]
+            if not [t for t in targets if t[1] is None] and targets==[
+                    (type(e),e.target) for e in last]:
+                for a,b in zip(last,edits):
+                    a.new=b.new
+                return edits
+        self.merging=merge
+        self.undo_stack.append(edits)
+        if self.maxlen and len(self.undo_stack)>self.maxlen:
+            self.undo_stack.pop(0)
+        return edits
+
+    def undo(self):
+        """Revert last step and return its edits (None if nothing to undo)."""
+        if not self.undo_stack:
+            return None
+        edits=self.undo_stack.pop()
+        self.run(edits,undo=True)
+        self.redo_stack.append(edits)
+        self.merging=False
+        return edits
+
+    def redo(self):
+        """Apply again the last step undone, and return its edits."""
+        if not self.redo_stack:
+            return None
+        edits=self.redo_stack.pop()
+        self.run(edits)
+        self.undo_stack.append(edits)
+        self.merging=False
+        return edits
+
+    def clear(self):
+        self.undo_stack[:]=[]
+        self.redo_stack[:]=[]
+        self.merging=False
+
+
+class Autosave(object):
+    """Save data once no edit has been made for delay seconds, so that
+    bursts of edits result in a single write.
+
+    The data is exported and written to the file in a background thread,
+    once poll (called regularly by the thread editing the data, e.g. from
+    a timer of the event loop) finds that edits have stopped. If the data
+    is edited during the export, the export is dropped: it is made again
+    once these edits have stopped in turn.
+
+    Attributes:
+        path (str): File written.
+        export (callable): Returns the text to save, as a list of strings
+            (e.g. from IOHandler.iter_export), called by the background thread.
+        version (callable): Returns a number that is odd while the data is
+            being edited and changes with every edit (e.g. EditHistory.version).
+        error: Last error raised when writing the file, or None.
+
+    Call touch after every edit. Pending edits are also saved by flush
+    and close. The file is left in place until discard is called (e.g.
+    once the data has been saved), so that it can be recovered after a
+    crash (see exists)."""
+
+    def __init__(self,path,export,version=lambda:0,delay=2.):
+        import threading,Queue
+        self.path=path
+        self.export=export
+        self.version=version
+        self.delay=delay
+        self.generation=0 #Number of edits made
+        self.exported=0 #Number of edits queued for export
+        self.last_edit=0
+        self.error=None
+        self.queue=Queue.Queue()
+        self.thread=threading.Thread(target=self.run)
+        self.thread.daemon=True
+        self.thread.start()
+
+    def exists(self):
+        """True if the file holds data that was not discarded."""
+        import os
+        return os.path.isfile(self.path)
+
+    def touch(self):
+        """Signal that data has changed."""
+        import time
+        self.generation+=1
+        self.last_edit=time.time()
+
+    def poll(self):
+        """Export the data if edits are pending and none was made for
+        delay seconds."""
+        import time
+        if self.exported<self.generation and time.time()-self.last_edit>=self.delay:
+            self.save()
+
+    def save(self):
+        """Queue the data for export and writing."""
+        self.exported=self.generation
+        self.queue.put(self.generation)
+
+    def run(self):
+        while True:
+            request=self.queue.get()
+            try:
+                if request is None:
+                    return
+                chunks=self.snapshot()
+                if chunks is not None:
+                    self.write(chunks)
+            finally:
+                self.queue.task_done()
+
+    def snapshot(self):
+        """Export the data once it is not being edited, or return None if
+        it was edited during the export (poll queues it again once these
+        edits stop)."""
+        import time
+        version=self.version()
+        while version%2:
+            time.sleep(.05)
+            version=self.version()
+        try:
+            chunks=self.export()
+        except RuntimeError:
+            #Containers changed size during export
+            return None
+        if self.version()!=version:
+            return None
+        return chunks
+
+    def write(self,chunks):
+        """Replace the file with the exported text."""
+        import os
+        try:
+            fout=open(self.path+'.tmp','w')
+            for txt in chunks:
+                fout.write(txt)
+            fout.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path+'.tmp',self.path)
+            self.error=None
+        except EnvironmentError as e:
+            self.error=e
+            print 'Autosave: could not write {}: {}'.format(self.path,e)
+
+    def flush(self):
+        """Export pending edits now, and wait until they are written
+        (the data must not be edited meanwhile)."""
+        if self.exported<self.generation:
+            self.save()
+        self.queue.join()
+
+    def discard(self):
+        """Delete the file, once the data is safe elsewhere."""
+        import os
+        self.queue.join()
+        self.exported=self.generation
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        """Flush and stop the background thread."""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Journal(object):
+    """Append-only log of the edits made to the data of a source file,
+    stored next to it (source.journal) and replayed when it is opened again,
+    so that edits are kept without rewriting the whole file.
+
+    The first line is a JSON header naming the file the edits apply to,
+    with its sha1: either the source itself, or source.compact (the header
+    then also holds the sha1 of the source when it was written, so that
+    the journal is dropped if the source changes). Each
+    following line is a JSON list of changes made by one Edit (see encode),
+    locating objects by their position rather than their uid.
+    Once the journal grows past threshold bytes, the data is exported in
+    a background thread to source.compact (in binary format, see
+    IOHandler.export_binary), and the journal starts over from it.
+    That thread reads SQLite databases through its own connections, which
+    only see committed changes: edits are committed as they are recorded
+    while it runs.
+    The source file itself is never written."""
+
+    def __init__(self,source,threshold=1<<20):
+        import threading
+        self.source=str(Path(source).norm())
+        self.path=self.source+'.journal'
+        self.compact_path=self.source+'.compact'
+        self.threshold=threshold
+        self.lock=threading.Lock()
+        self.fout=None
+        self.compacting=False
+        self.parents={}
+
+    def base(self):
+        """File that the journal applies to, or None if there is no journal
+        or that file has changed since."""
+        import json,os
+        if not os.path.isfile(self.path):
+            return None
+        fin=open(self.path,'r')
+        try:
+            header=self.plain(json.loads(fin.readline()))
+            base=header['base']
+            if not base in (self.source,self.compact_path):
+                return None
+            if ParseCache.file_hash(base)!=header['hash']:
+                return None
+            if ParseCache.file_hash(self.source)!=header['source']:
+                return None
+        except (ValueError,KeyError,EnvironmentError):
+            return None
+        finally:
+            fin.close()
+        return base
+
+    def replay(self,handler,sequences):
+        """Apply the changes in the journal to data parsed by handler
+        from the base file."""
+        import json
+        fin=open(self.path,'r')
+        fin.readline()
+        for line in fin:
+            try:
+                changes=self.plain(json.loads(line))
+            except ValueError:
+                #Last line was not completely written
+                break
+            for change in changes:
+                self.apply_change(change,handler,sequences)
+        fin.close()
+
+    def open(self,handler,sequences,history,resume=False):
+        """Record edits made through history to data (from handler).
+        Unless resume is True, start a new journal on the source file."""
+        self.handler,self.sequences,self.history=handler,sequences,history
+        self.index_objects()
+        if resume:
+            self.fout=open(self.path,'a')
+        else:
+            self.restart(self.source)
+        history.listeners.append(self.record)
+
+    def restart(self,base):
+        """Replace the journal by an empty one applying to base."""
+        import json,os
+        if self.fout:
+            self.fout.close()
+        fout=open(self.path+'.tmp','w')
+        fout.write(json.dumps({'base':base,'hash':ParseCache.file_hash(base),
+            'source':ParseCache.file_hash(self.source)})+'\n')
+        fout.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path+'.tmp',self.path)
+        self.fout=open(self.path,'a')
+        if base==self.source and os.path.exists(self.compact_path):
+            os.remove(self.compact_path)
+
+    def close(self,remove=False):
+        """Stop recording, and delete the journal if remove is True
+        (e.g. once the data has been saved)."""
+        import os
+        if hasattr(self,'history') and self.record in self.history.listeners:
+            self.history.listeners.remove(self.record)
+        with self.lock:
+            if self.fout:
+                self.fout.close()
+                self.fout=None
+            if remove:
+                for path in (self.path,self.compact_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def record(self,edit,undo=False):
+        """Append the changes made by edit (or by reverting it)."""
+        import json,os,threading
+        line=json.dumps(self.encode(edit,undo))+'\n'
+        with self.lock:
+            if not self.fout:
+                return
+            self.fout.write(line)
+            self.fout.flush()
+            size=os.fstat(self.fout.fileno()).st_size
+        start=size>self.threshold and not self.compacting
+        if start:
+            self.compacting=True
+        if self.compacting:
+            for db in self.handler.databases():
+                db.commit()
+        if start:
+            thread=threading.Thread(target=self.compact)
+            thread.daemon=True
+            thread.start()
+
+    def checkpoint(self):
+        """Export the data to the compact file now (in the calling thread,
+        which must be the one editing the data), and restart the journal
+        from it, e.g. after the source has changed."""
+        import os
+        with self.lock:
+            self.handler.export_binary(self.compact_path+'.new',self.sequences)
+            if os.path.exists(self.compact_path):
+                os.remove(self.compact_path)
+            os.rename(self.compact_path+'.new',self.compact_path)
+            self.restart(self.compact_path)
+
+    def compact(self):
+        """Export the data to the compact file, and restart the journal
+        from it. The export is repeated if edits are made meanwhile."""
+        import os,time
+        from cStringIO import StringIO
+        handler=self.handler.reader()
+        try:
+            for attempt in range(20):
+                version=self.history.version
+                if version%2:
+                    time.sleep(.05)
+                    continue
+                buf=StringIO()
+                try:
+                    handler.export_binary(buf,self.sequences)
+                except RuntimeError:
+                    #Containers changed size during export
+                    continue
+                fout=open(self.compact_path+'.tmp','wb')
+                fout.write(buf.getvalue())
+                fout.close()
+                with self.lock:
+                    if self.history.version!=version or not self.fout:
+                        continue
+                    if os.path.exists(self.compact_path):
+                        os.remove(self.compact_path)
+                    os.rename(self.compact_path+'.tmp',self.compact_path)
+                    self.restart(self.compact_path)
+                return
+        finally:
+            handler.close()
+            if os.path.exists(self.compact_path+'.tmp'):
+                os.remove(self.compact_path+'.tmp')
+            self.compacting=False
+
+    #Encoding of edits
+
+    def index_objects(self):
+        """Map each Sequence, Frame and Action (by id) to itself and the
+        object whose list contains it (None for sequences)."""
+        self.parents={}
+        for seq in self.sequences:
+            self.parents[id(seq)]=(seq,None)
+            for fr in seq.frames:
+                self.parents[id(fr)]=(fr,seq)
+                for act in fr.actions:
+                    self.parents[id(act)]=(act,fr)
+
+    def address(self,obj):
+        """Position of a Sequence, Frame or Action in the sequences, found
+        by going up its containers (the map of containers is rebuilt if
+        obj was added or moved since)."""
+        if not isinstance(obj,(Sequence,Frame,Action)):
+            return None
+        for attempt in range(2):
+            at,x=[],obj
+            while x is not None and id(x) in self.parents:
+                x,parent=self.parents[id(x)]
+                if parent is None:
+                    siblings=self.sequences
+                elif isinstance(parent,Sequence):
+                    siblings=parent.frames
+                else:
+                    siblings=parent.actions
+                pos=[k for k,y in enumerate(siblings) if y is x]
+                if not pos:
+                    break
+                at.insert(0,pos[0])
+                x=parent
+            else:
+                if x is None:
+                    return at
+            self.index_objects()
+        return None
+
+    def encode_value(self,val):
+        if isinstance(val,Relation):
+            return {'type':'relation','nodes':[getattr(z,'uid',z) for z in val.nodes],
+                'atoms':list(val.atoms)}
+        if isinstance(val,Action):
+            return {'type':'action','uid':val.uid,'atoms':list(val.atoms),
+                'roles':[[n.uid,list(v)] for n,v in val.roles.iteritems()],
+                'states':[[n.uid,list(v)] for n,v in val.states.iteritems()],
+                'relations':[self.encode_value(r) for r in val.relations]}
+        if isinstance(val,Frame):
+            return {'type':'frame','uid':val.uid,'atoms':list(val.atoms),
+                'actions':[self.encode_value(a) for a in val.actions]}
+        if isinstance(val,Sequence):
+            return {'type':'sequence','uid':val.uid,'atoms':list(val.atoms),
+                'frames':[self.encode_value(f) for f in val.frames]}
+        return val
+
+    def encode(self,edit,undo=False):
+        """List of changes (JSON-compatible dicts) made by applying edit,
+        or reverting it if undo is True."""
+        if isinstance(edit,SetText):
+            value=edit.new
+            if undo:
+                value=edit.old if edit.existed else None
+            return [{'op':'text','uid':edit.uid,'typ':edit.typ,'value':value}]
+        if isinstance(edit,(AddEdge,RemEdge)):
+            add=isinstance(edit,AddEdge)!=undo
+            change={'op':'addedge' if add else 'remedge','db':edit.obj.typ,
+                'edge':list(edit.edge)}
+            if add and isinstance(edit,RemEdge):
+                change['index']=edit.index
+            return [change]
+        change={'at':self.address(edit.obj),'attr':edit.attr}
+        if isinstance(edit,SetAttr):
+            change.update(op='set',value=self.encode_value(edit.old if undo else edit.new))
+        elif isinstance(edit,SetItem):
+            key=getattr(edit.key,'uid',edit.key)
+            if undo and edit.old is SetItem.MISSING:
+                change.update(op='delitem',key=key)
+            else:
+                change.update(op='setitem',key=key,
+                    value=self.encode_value(edit.old if undo else edit.new))
+        elif isinstance(edit,(InsertItem,RemoveItem)):
+            if isinstance(edit,InsertItem)!=undo:
+                change.update(op='insert',index=edit.index,item=self.encode_value(edit.item))
+            else:
+                change.update(op='remove',index=edit.index)
+        return [change]
+
+    #Decoding
+
+    @staticmethod
+    def plain(val):
+        """Replace unicode strings from json by utf-8 encoded str."""
+        if isinstance(val,unicode):
+            return val.encode('utf-8')
+        if isinstance(val,list):
+            return [Journal.plain(x) for x in val]
+        if isinstance(val,dict):
+            return dict((Journal.plain(k),Journal.plain(v)) for k,v in val.iteritems())
+        return val
+
+    def decode_value(self,val,handler):
+        if not isinstance(val,dict):
+            return val
+        typ=val['type']
+        if typ=='relation':
+            for n in val['nodes']:
+                handler.parse_node(n)
+            return Relation(val['nodes'],val['atoms'])
+        if typ=='action':
+            return Action(val['uid'],val['atoms'],
+                roles=OrderedDict((handler.parse_node(n),v) for n,v in val['roles']),
+                states=OrderedDict((handler.parse_node(n),v) for n,v in val['states']),
+                relations=[self.decode_value(r,handler) for r in val['relations']])
+        if typ=='frame':
+            return Frame(val['uid'],val['atoms'],
+                [self.decode_value(a,handler) for a in val['actions']])
+        if typ=='sequence':
+            return Sequence(val['uid'],val['atoms'],
+                [self.decode_value(f,handler) for f in val['frames']])
+
+    def apply_change(self,change,handler,sequences):
+        """Apply one change, as given by encode, to data from handler."""
+        op=change['op']
+        if op=='text':
+            if change['value'] is None:
+                entry=handler.text_db.db.get(change['uid'],{})
+                entry.pop(change['typ'],None)
+                if not entry:
+                    handler.text_db.db.pop(change['uid'],None)
+            else:
+                handler.text_db.set(change['uid'],change['typ'],change['value'])
+            return
+        if op in ('addedge','remedge'):
+            db=getattr(handler,'{}_db'.format(change['db']))
+            edge=tuple(change['edge'])
+            if op=='remedge':
+                db.rem_edge(*edge,reciprocal=False)
+            else:
+                db.add_edge(*edge)
+                if 'index' in change:
+                    db.edges.insert(change['index'],edge)
+            return
+        at,attr=change['at'],change['attr']
+        if at is None:
+            obj,container=None,sequences
+        else:
+            obj=sequences[at[0]]
+            if len(at)>1:
+                obj=obj.frames[at[1]]
+            if len(at)>2:
+                obj=obj.actions[at[2]]
+            container=getattr(obj,attr)
+        if op=='set':
+            setattr(obj,attr,self.decode_value(change['value'],handler))
+            return
+        key=change.get('key')
+        if attr in ('states','roles'):
+            key=handler.parse_node(key)
+        if op=='setitem':
+            container[key]=self.decode_value(change['value'],handler)
+        elif op=='delitem':
+            del container[key]
+        elif op=='insert':
+            item=self.decode_value(change['item'],handler)
+            if isinstance(obj,Sequence) and attr=='frames':
+                obj.add_frame(item,change['index'])
+            else:
+                container.insert(change['index'],item)
+        elif op=='remove':
+            if isinstance(obj,Sequence) and attr=='frames':
+                obj.rem_frame(container[change['index']])
+            else:
+                del container[change['index']]